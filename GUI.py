@@ -1,23 +1,30 @@
+import time
+START = time.perf_counter()
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter import filedialog
-from tkinter.filedialog import asksaveasfile
-from screeninfo import get_monitors
-import pickle
-import os
-import dbsql
-import model
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use('TkAgg')
+import instrument
+import jobs
+
+WATCH_INTERVAL = 1000
 
 
 class GUI(tk.Tk):
     def __init__(self):
+        self.timings = {"imports": time.perf_counter() - START}
         super().__init__()
-        self.db = dbsql.DbSQL("wine_database.db", "wine.data")
-        self.model = model.Model(self.db)
-
+        self.db = None
+        self.model = None
+        self.load_error = None
+        self.jobs = jobs.Scheduler(self)
+        # plots and table pages only read the database, their own worker keeps them responsive during training
+        self.reads = jobs.Scheduler(self)
+        self.loader = threading.Thread(target=self.load, daemon=True)
+        self.loader.start()
+
+        # screeninfo is only needed for the window size, import it when the window is built
+        from screeninfo import get_monitors
         self.screen_width = get_monitors()[0].width
         self.screen_height = get_monitors()[0].height
 
@@ -41,6 +48,11 @@ class GUI(tk.Tk):
         save_button = tk.Button(question_frame, text="Save model", font=("Arial", 12), command=self.save_window)
         read_button = tk.Button(question_frame, text="Read model", font=("Arial", 12), command=self.read_window)
 
+        self.data_buttons = [train_button, test_button, predict_button, add_button, rebuild_button, table_button,
+                              graph_button, save_button, read_button]
+        for button in self.data_buttons:
+            button.configure(state="disabled")
+
         train_button.pack(side="left", anchor="n", padx=5)
         test_button.pack(side="left", anchor="n", padx=5)
         predict_button.pack(side="left", anchor="n", padx=5)
@@ -60,8 +72,57 @@ class GUI(tk.Tk):
         info_button = tk.Button(self, text="info", image=info_icon, command=self.info_window)
         info_button.pack(side="right", anchor="nw", padx=5, pady=15)
 
+        self.status_label = tk.Label(question_frame, text="Loading data...", font=("Arial", 10))
+        self.status_label.pack(side="bottom", pady=5)
+
+        self.after_idle(self.window_shown)
+        self.after(50, self.check_loaded)
         self.mainloop()
 
+    def load(self):
+        try:
+            start = time.perf_counter()
+            import dbsql
+            import model
+            import registry
+            self.timings["import_model"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            self.db = dbsql.DbSQL("wine_database.db", "wine.data")
+            self.timings["database"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            self.model = model.Model(self.db)
+            self.model.registry = registry.Registry()
+            self.timings["model"] = time.perf_counter() - start
+        except Exception as e:
+            self.load_error = e
+
+    def window_shown(self):
+        self.timings["first_window"] = time.perf_counter() - START
+
+    def check_loaded(self):
+        if self.loader.is_alive():
+            self.after(50, self.check_loaded)
+            return
+        if self.load_error is not None:
+            self.status_label.configure(text=f"Could not load data: {self.load_error}")
+            return
+
+        self.timings["ready"] = time.perf_counter() - START
+        self.status_label.configure(text="")
+        for button in self.data_buttons:
+            button.configure(state="normal")
+        print("Startup: " + ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.timings.items()))
+        self.after(WATCH_INTERVAL, self.watch_changes)
+
+    def watch_changes(self):
+        # the model follows the database change feed, rows added by any writer are learned without a rebuild
+        if self.model.pending():
+            self.jobs.submit("update", lambda job: self.model.update())
+        self.after(WATCH_INTERVAL, self.watch_changes)
+
+    @instrument.timed("gui.info_window", action=True)
     def info_window(self):
         window = tk.Toplevel(self)
         window.title("Dataset info")
@@ -80,68 +141,29 @@ class GUI(tk.Tk):
         close_button = tk.Button(window, text="Close", command=window.destroy)
         close_button.pack(pady=5)
 
+    @instrument.timed("gui.table_window", action=True)
     def table_window(self):
+        import tableview
+
         window = tk.Toplevel(self)
         window.title("Table view")
         window.geometry(f"{int(self.screen_width / 1.5)}x{int(self.screen_height / 2)}")
 
-        scroll = tk.Scrollbar(window, orient="vertical")
-        scroll.pack(side="right", fill="y")
-
-        treeview = ttk.Treeview(window, yscrollcommand=scroll.set)
-        treeview["columns"] = ("alcohol", "malic_acid", "ash", "alcalinity_of_ash", "magnesium",
-                               "total_phenols", "flavanoids", "nonflavanoid_phenols", "proanthocyanins",
-                               "color_intensity", "hue", "diluted", "proline", "category")
-
-        treeview.column("#0", width=0)
-        treeview.heading("alcohol", text="Alcohol")
-        treeview.heading("malic_acid", text="Malic acid")
-        treeview.heading("ash", text="Ash")
-        treeview.heading("alcalinity_of_ash", text="Alcalinity of ash")
-        treeview.heading("magnesium", text="Magnesium")
-        treeview.heading("total_phenols", text="Total phenols")
-        treeview.heading("flavanoids", text="Flavanoids")
-        treeview.heading("nonflavanoid_phenols", text="Nonflavanoid phenols")
-        treeview.heading("proanthocyanins", text="Proanthocyanins")
-        treeview.heading("color_intensity", text="Color intensity")
-        treeview.heading("hue", text="Hue")
-        treeview.heading("diluted", text="OD280/OD315 of diluted wines")
-        treeview.heading("proline", text="Proline")
-        treeview.heading("category", text="Category")
-
-        for col in treeview["columns"]:
-            treeview.column(col, width=90)
-
-        scroll.config(command=treeview.yview)
-        treeview.pack(fill="both", expand=True)
-        data = self.db.fetch_data()
-        treeview.delete(*treeview.get_children())
-        for row in data:
-            d = list()
-            for i in range(len(row)):
-                d.append(row[i])
-            treeview.insert("", "end", values=tuple(d))
+        table = tableview.TableView(window, self.db, self.reads)
+        table.pack(fill="both", expand=True)
 
+    @instrument.timed("gui.graph_window", action=True)
     def graph_window(self):
-        data = self.db.fetch_data()
-        dataset = {}
-        for i in range(len(data)):
-            item = data[i]
-            key = item[-1]
-            if key not in dataset.keys():
-                dataset[key] = 1
-            else:
-                dataset[key] = dataset[key] + 1
+        import plots
 
-        keys = list(dataset.keys())
-        values = list(dataset.values())
+        window = tk.Toplevel(self)
+        window.title("Graphs")
+        window.geometry(f"{int(self.screen_width / 2)}x{int(self.screen_height / 2)}")
 
-        plt.bar(keys, values, width=0.4)
-        plt.xlabel("Category")
-        plt.ylabel("Count")
-        plt.title("Number of instances per category")
-        plt.show()
+        view = plots.PlotView(window, self.db, self.reads)
+        view.pack(fill="both", expand=True)
 
+    @instrument.timed("gui.add_window", action=True)
     def add_window(self):
         window = tk.Toplevel(self)
         window.title("Add new item")
@@ -216,6 +238,16 @@ class GUI(tk.Tk):
         category_entry = tk.Entry(window)
         category_entry.pack()
 
+        error_label = tk.Label(window, text="")
+        error_label.pack()
+
+        @instrument.timed("gui.add_item", action=True)
+        def add_item_timed(data):
+            import dbsql
+            self.db.insert_data(dbsql.parse_row(data))
+            # the model learns the new row on the job thread, the single worker runs every model change in order
+            self.jobs.submit("update", lambda job: self.model.update())
+
         def add_item():
             data = list()
             data.append(alcohol_entry.get())
@@ -233,13 +265,17 @@ class GUI(tk.Tk):
             data.append(proline_entry.get())
             data.append(category_entry.get())
 
-            self.db.insert_data(data)
-            self.model.refresh(self.db)
+            try:
+                add_item_timed(data)
+            except ValueError as e:
+                error_label.configure(text=f"Error: {e}")
+                return
             window.destroy()
 
         add_button = tk.Button(window, text="Add", command=add_item)
         add_button.pack(pady=5)
 
+    @instrument.timed("gui.test_window", action=True)
     def test_window(self):
         ev_window = tk.Toplevel(self)
         ev_window.title("Testing")
@@ -259,11 +295,19 @@ class GUI(tk.Tk):
 
         else:
 
+            def evaluate(job, tset):
+                job.report(0.0, "Evaluating")
+                res = self.model.evaluate(tset)
+                return res["accuracy"], res["matrix"], res["report"]
+
             def ev(tset):
-                acc = self.model.evaluate_accuracy(tset)
-                matrix = self.model.evaluate_matrix(tset)
-                report = self.model.evaluate_report(tset)
+                acc_label.configure(text="Accuracy:\t...")
+                self.jobs.submit(("test", tset), evaluate, tset, on_done=show)
 
+            def show(result):
+                if not ev_window.winfo_exists():
+                    return
+                acc, matrix, report = result
                 acc_label.configure(text="Accuracy:\t" + str(acc))
 
                 conf_matrix.delete(*conf_matrix.get_children())
@@ -320,6 +364,7 @@ class GUI(tk.Tk):
             frame2.pack(side="bottom", padx=10, pady=10, fill="both")
             ev("test")
 
+    @instrument.timed("gui.train_window", action=True)
     def train_window(self):
         window = tk.Toplevel(self)
         window.title("Train model")
@@ -347,20 +392,67 @@ class GUI(tk.Tk):
         slider.configure(state="disabled")
         slider.pack()
 
+        import model
+        engine_label = tk.Label(window, text="Estimator")
+        engine_label.pack()
+        engine_var = tk.StringVar(value=self.model.engine)
+        engine_menu = tk.OptionMenu(window, engine_var, *model.ENGINES)
+        engine_menu.pack()
+
+        # estimators without partial_fit skip new rows until they are trained again
+        progress_label = tk.Label(window, text="New rows since the last training" if self.model.stale else "")
+        progress_label.pack()
+
+        def show_progress(progress, message):
+            if window.winfo_exists():
+                progress_label.configure(text=f"{message} {progress:.0%}" if message else "")
+
+        def show_error(error):
+            if window.winfo_exists():
+                progress_label.configure(text=f"Error: {error}")
+                button.configure(state="normal")
+
+        def run_training(job, split, size, engine):
+            job.report(0.0, "Training")
+            self.model.train(split, size, engine, job.check)
+            job.report(1.0, "Done")
+
+        def trained(result):
+            if window.winfo_exists():
+                button.configure(state="normal")
+                ev_button.configure(state="normal")
+
         def train():
-            self.model.train(radio_var.get(), slider.get())
-            ev_button.configure(state="normal")
+            button.configure(state="disabled")
+            self.jobs.submit("train", run_training, radio_var.get(), slider.get(), engine_var.get(), on_done=trained,
+                             on_error=show_error, on_progress=show_progress)
+
+        def cancel():
+            self.jobs.cancel("train")
+            self.jobs.cancel("evaluate")
+            button.configure(state="normal")
+            progress_label.configure(text="Cancelled")
 
         button_frame = tk.Frame(window)
         button_frame.pack(side="bottom", fill="y", expand=True)
 
+        def run_evaluation(job):
+            job.report(0.0, "Evaluating")
+            return self.model.evaluate_best("train", job.check)
+
         def evaluate():
+            self.jobs.submit("evaluate", run_evaluation, on_done=show_evaluation, on_error=show_error,
+                             on_progress=show_progress)
+
+        def show_evaluation(res):
+            if not window.winfo_exists():
+                return
+            progress_label.configure(text="")
             ev_window = tk.Toplevel(self)
             ev_window.title("Evaluation")
             ev_window.geometry(f"{int(self.screen_width / 2)}x{int(self.screen_height / 3)}")
             ev_window.resizable(width=False, height=False)
 
-            res = self.model.evaluate_best("train")
             avg = res["avg"]
             param_grid = res["param_grid"]
             best_param = res["best_param"]
@@ -397,17 +489,23 @@ class GUI(tk.Tk):
 
         button = tk.Button(button_frame, text="Train", command=train)
         ev_button = tk.Button(button_frame, text="Evaluate", command=evaluate)
+        cancel_button = tk.Button(button_frame, text="Cancel", command=cancel)
         ev_button.configure(state="disabled")
         button.pack(side="left")
+        cancel_button.pack(side="left")
         ev_button.pack(side="right")
 
+    @instrument.timed("gui.rebuild_window", action=True)
     def rebuild_window(self):
-        self.model.rebuild(self.db)
-        window = tk.Toplevel(self)
-        window.title("Result")
-        label = tk.Label(window, text="Success!", font=("Arial", 12))
-        label.pack(anchor="center")
+        def rebuilt(result):
+            window = tk.Toplevel(self)
+            window.title("Result")
+            label = tk.Label(window, text="Success!", font=("Arial", 12))
+            label.pack(anchor="center")
+
+        self.jobs.submit("rebuild", lambda job: self.model.rebuild(self.db), on_done=rebuilt)
 
+    @instrument.timed("gui.predict_window", action=True)
     def predict_window(self):
         window = tk.Toplevel(self)
         window.title("Predict new entry")
@@ -480,6 +578,8 @@ class GUI(tk.Tk):
         prediction_label = tk.Label(window, text="Predicted category:\t", font=("Arial", 12))
         prediction_label.pack()
 
+        predict_timed = instrument.wrap("gui.predict_item", self.model.predict, action=True)
+
         def predict_item():
             listdata = []
             data = []
@@ -498,31 +598,90 @@ class GUI(tk.Tk):
             data.append(proline_entry.get())
 
             listdata.append(data)
-            res = self.model.predict(listdata)
+            res = predict_timed(listdata)
 
             if res == "0":
                 prediction_label.configure(text="Please train the model first!")
             else:
-                prediction_label.configure(text="Predicted category:\t" + res)
+                prediction_label.configure(text="Predicted category:\t" + str(res))
 
         pred_button = tk.Button(window, text="Predict", command=predict_item)
         pred_button.pack(pady=5)
 
+    @instrument.timed("gui.save_window", action=True)
     def save_window(self):
-        files = [('All Files', '*.*'),
-                 ('Python Files', '*.py'),
-                 ('Text Document', '*.txt')]
-        file = asksaveasfile(filetypes=files)
+        def show_error(text):
+            window = tk.Toplevel(self)
+            window.title("Save model")
+            label = tk.Label(window, text=text, font=("Arial", 12))
+            label.pack(anchor="center", padx=10, pady=10)
+
+        # checked before the dialog, so a model that cannot be saved leaves no empty file behind
+        if not self.model.fitted():
+            show_error("Please train the model first!")
+            return
+        if self.model.engine != "gaussian_nb":
+            show_error(f"Only gaussian_nb models can be saved, this one uses {self.model.engine}")
+            return
+
+        files = [('Model files', '*.npz'),
+                 ('All Files', '*.*')]
+        filename = filedialog.asksaveasfilename(filetypes=files, defaultextension=".npz")
+
+        if filename:
+            try:
+                self.model.save(filename)
+            except (ValueError, OSError) as e:
+                print(f"Error: {e}")
+                show_error(f"Error: {e}")
+
+    @instrument.timed("gui.read_window", action=True)
+    def read_window(self):
+        window = tk.Toplevel(self)
+        window.title("Read model")
+
+        columns = ("engine", "rows", "test_size", "avg", "best_score", "created")
+        models = ttk.Treeview(window, columns=columns, show="headings", height=10, selectmode="browse")
+        for column in columns:
+            models.heading(column, text=column.replace("_", " ").capitalize())
+            models.column(column, width=110)
+        for meta in self.model.registry.entries():
+            metrics = meta["metrics"]
+            models.insert("", "end", iid=meta["key"],
+                          values=(meta["engine"], meta["rows"], meta["test_size"], f"{metrics['avg']:.4f}",
+                                  f"{metrics['best_score']:.4f}",
+                                  time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["created"]))))
+        models.pack(fill="both", expand=True, padx=5, pady=5)
+
+        status_label = tk.Label(window, text="")
+        status_label.pack()
+
+        def use_model():
+            selected = models.selection()
+            if not selected:
+                return
+            status_label.configure(text="Loading...")
+            self.jobs.submit(("use", selected[0]), lambda job: self.model.use(selected[0]), on_done=used)
+
+        def used(result):
+            if not window.winfo_exists():
+                return
+            if result:
+                window.destroy()
+            else:
+                status_label.configure(text="This model was trained on rows that are no longer loaded")
 
-        if file is not None:
-            with open(file.name, 'wb') as f:
-                pickle.dump(self.model, f)
-            file.close()
+        def read_file():
+            filename = filedialog.askopenfilename(initialdir="/", title="Select a File",
+                                                  filetypes=(("Model files", "*.npz"), ("all files", "*.*")))
+            if filename != "":
+                self.jobs.submit(("load", filename), lambda job: self.model.load(filename))
+                window.destroy()
 
-    def read_window(self):
-        filename = filedialog.askopenfilename(initialdir="/", title="Select a File",
-                                              filetypes=(("Text files", "*.txt*"), ("all files", "*.*")))
-        if filename != "":
-            with open(filename, 'rb') as file:
-                readmodel = pickle.load(file)
-                self.model = readmodel
+        models.bind("<Double-1>", lambda event: use_model())
+        button_frame = tk.Frame(window)
+        button_frame.pack(side="bottom", pady=5)
+        use_button = tk.Button(button_frame, text="Use model", command=use_model)
+        use_button.pack(side="left", padx=5)
+        file_button = tk.Button(button_frame, text="From file...", command=read_file)
+        file_button.pack(side="left", padx=5)
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import sklearn
+
+import dbsql
+import featurestore
+import model
+
+STAGES = ("read_from_file", "fetch_data", "fetch_arrays", "insert_data", "insert_many", "model_init", "train",
+          "evaluate_best", "evaluate_best_cached", "evaluate_sharded", "predict", "predict_batch", "fit_stats",
+          "store_export", "train_store")
+SIZES = (178, 10000, 100000)
+SINGLE_ROWS = 1000
+
+
+def class_profiles(file="wine.data"):
+    data = np.loadtxt(file, delimiter=",")
+    classes, counts = np.unique(data[:, 0], return_counts=True)
+    profiles = []
+    for category, count in zip(classes, counts):
+        rows = data[data[:, 0] == category, 1:]
+        profiles.append((int(category), count / len(data), rows.mean(axis=0), rows.std(axis=0)))
+    return profiles
+
+
+def synthesize(file, rows, profiles, seed=0, chunk_size=dbsql.CHUNK_SIZE):
+    rng = np.random.default_rng(seed)
+    weights = np.array([profile[1] for profile in profiles])
+    with open(file, "w") as out:
+        for start in range(0, rows, chunk_size):
+            n = min(chunk_size, rows - start)
+            picks = rng.choice(len(profiles), size=n, p=weights)
+            block = np.empty((n, len(dbsql.COLUMNS)))
+            for i, (category, _, mean, std) in enumerate(profiles):
+                mask = picks == i
+                block[mask, 0] = category
+                block[mask, 1:] = np.abs(rng.normal(mean, std, size=(mask.sum(), len(mean))))
+            np.savetxt(out, block, delimiter=",", fmt=["%d"] + ["%.4g"] * len(dbsql.FEATURES))
+
+
+def measure(name, rows, func, memory=True):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    stats = {"seconds": seconds, "rows": rows, "rows_per_sec": rows / seconds if seconds > 0 else None,
+             "peak_mb": peak}
+    print(f"{name:>22}: {seconds:9.4f}s {stats['rows_per_sec'] or 0:14.0f} rows/s"
+          + (f" {peak:10.1f} MB" if memory else ""))
+    return result, stats
+
+
+def run(rows, stages, directory, profiles, memory=True, seed=0):
+    data_file = os.path.join(directory, f"wine_{rows}.data")
+    database = os.path.join(directory, f"wine_{rows}.db")
+    synthesize(data_file, rows, profiles, seed)
+    single = [list(profiles[0][2]) + [profiles[0][0]]] * SINGLE_ROWS
+    results = {}
+
+    def stage(name, count, func):
+        if name not in stages:
+            return None
+        result, results[name] = measure(name, count, func, memory)
+        return result
+
+    print(f"{rows} rows")
+    db = stage("read_from_file", rows, lambda: dbsql.DbSQL(database, data_file)) or dbsql.DbSQL(database, data_file)
+    stage("fetch_data", rows, db.fetch_data)
+    stage("fetch_arrays", rows, db.fetch_arrays)
+    stage("insert_data", SINGLE_ROWS, lambda: [db.insert_data(row) for row in single])
+    stage("insert_many", SINGLE_ROWS, lambda: db.insert_many(single))
+    wines = stage("model_init", db.count(), lambda: model.Model(db)) or model.Model(db)
+    stage("train", wines.size, lambda: wines.train(False, 0))
+    # train already ran the search, drop its cache entry to time a cold search
+    stage("evaluate_best", wines.size, lambda: (wines.searches.clear(), wines.evaluate_best("train")))
+    stage("evaluate_best_cached", wines.size, lambda: wines.evaluate_best("train"))
+    stage("evaluate_sharded", wines.size, wines.evaluate_sharded)
+    if wines.fitted():
+        sample = wines.X[:SINGLE_ROWS]
+        stage("predict", len(sample), lambda: [wines.predict([row]) for row in sample])
+        stage("predict_batch", wines.size, lambda: wines.predict_batch(wines.X))
+    stage("fit_stats", wines.size, wines.fit_stats)
+    store = stage("store_export", wines.size, lambda: featurestore.FeatureStore.export(db, os.path.join(
+        directory, f"store_{rows}")))
+    if store is not None:
+        stage("train_store", len(store), lambda: wines.train_store(store))
+    db.close()
+    return {"rows": rows, "stages": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DbSQL and Model on synthetic wine data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="table sizes to benchmark")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES, help="stages to time")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak memory tracking")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the generated data files")
+    args = parser.parse_args()
+
+    profiles = class_profiles()
+    directory = tempfile.mkdtemp(prefix="wine_benchmark_")
+    try:
+        results = [run(rows, args.stages, directory, profiles, not args.no_memory, args.seed)
+                   for rows in args.sizes]
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "sklearn": sklearn.__version__,
+              "platform": platform.platform(),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
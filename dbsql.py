@@ -1,94 +1,881 @@
+import csv
+import gzip
+import itertools
+import json
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
+import numpy as np
 
+import instrument
+
+FEATURES = ("alcohol", "malic_acid", "ash", "alcalinity_of_ash", "magnesium", "total_phenols", "flavanoids",
+           "nonflavanoid_phenols", "proanthocyanins", "color_intensity", "hue", "diluted", "proline")
+COLUMNS = FEATURES + ("category",)
+INSERT_SQL = f"INSERT INTO Wines ({', '.join(COLUMNS)}) VALUES({', '.join('?' * len(COLUMNS))})"
+SELECT_SQL = f"SELECT {', '.join(COLUMNS)} FROM Wines"
+SELECT_AFTER_SQL = f"{SELECT_SQL} WHERE rowid > ? ORDER BY rowid"
+SELECT_CHUNK_SQL = (f"SELECT rowid, {', '.join(COLUMNS)} FROM Wines WHERE rowid > ? AND rowid <= ? "
+                    f"ORDER BY rowid LIMIT ?")
+MAX_ROWID = 2 ** 63 - 1
+STATS_SQL = "SELECT category, feature, n, total, total_sq, mean, m2 FROM WineStats"
+PREDICTION_SQL = "INSERT OR REPLACE INTO Predictions VALUES(?, ?)"
+STATEMENT_CACHE_SIZE = 256
+CHUNK_SIZE = 50000
+# cached aggregates merge up to this many new rows, beyond that one SQL pass is cheaper
+AGGREGATE_DELTA_ROWS = CHUNK_SIZE
+SCHEMA_VERSION = 3
+# WineBins splits about eight standard deviations of every feature into this many bins
+FINE_BINS = 512
+# bin widths derived from fewer rows are derived again each time the table doubles
+BIN_STEP_ROWS = 1000
+# bin indices are clipped here so far outliers still fit an INTEGER key
+MAX_BIN = 2 ** 52
+# unix time with millisecond resolution, julianday works on SQLite builds older than unixepoch()
+NOW_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def open_data_file(file):
+    with open(file, "rb") as probe:
+        magic = probe.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(file, "rt", newline="")
+    return open(file, newline="")
+
+
+def read_chunks(file_object, chunk_size=CHUNK_SIZE):
+    reader = csv.reader(file_object)
+    while True:
+        lines = list(filter(None, itertools.islice(reader, chunk_size)))
+        if not lines:
+            return
+        yield reorder_chunk(lines)
+
+
+def reorder_chunk(lines):
+    # UCI rows start with the category, the Wines table keeps it in the last column
+    if len(set(map(len, lines))) != 1 or len(lines[0]) != len(COLUMNS):
+        raise ValueError(f"Expected {len(COLUMNS)} values in every line")
+    columns = list(zip(*lines))
+    features = [map(float, column) for column in columns[1:]]
+    return list(zip(*features, map(int, columns[0])))
+
+
+def parse_row(values):
+    # typed input from a form: every feature a finite number, the category a whole number such as "2" or "2.0"
+    if len(values) != len(COLUMNS):
+        raise ValueError(f"Expected {len(COLUMNS)} values")
+    row = []
+    for name, value in zip(COLUMNS, values):
+        try:
+            number = float(str(value).strip())
+        except ValueError:
+            raise ValueError(f"{name} must be a number, got {value!r}") from None
+        if not np.isfinite(number):
+            raise ValueError(f"{name} must be finite")
+        row.append(number)
+    if not row[-1].is_integer():
+        raise ValueError(f"category must be a whole number, got {values[-1]!r}")
+    row[-1] = int(row[-1])
+    return row
+
+
+def check_column(column):
+    if column not in COLUMNS and column not in ("rowid", "id", "created_at"):
+        raise ValueError(f"Unknown column {column}")
+
+
+def create_tables(conn, suffix=""):
+    features = ", ".join(f"{name} REAL" for name in FEATURES)
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS Wines{suffix} (
+                                   id INTEGER PRIMARY KEY,
+                                   {features},
+                                   category INTEGER NOT NULL,
+                                   created_at REAL NOT NULL DEFAULT {NOW_SQL}) STRICT
+                                   ''')
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS Predictions{suffix} (
+                                   wine_id INTEGER PRIMARY KEY,
+                                   category INTEGER NOT NULL) STRICT
+                                   ''')
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS WineStats{suffix} (
+                                   category INTEGER NOT NULL,
+                                   feature TEXT NOT NULL,
+                                   n INTEGER NOT NULL,
+                                   total REAL NOT NULL,
+                                   total_sq REAL NOT NULL,
+                                   mean REAL NOT NULL,
+                                   m2 REAL NOT NULL,
+                                   PRIMARY KEY (category, feature)) STRICT
+                                   ''')
+
+
+def migrate_v2(conn):
+    # version 1 is the unversioned schema: implicit rowid, TEXT categories and no type checks.
+    # Rows are copied in bulk inside SQLite and keep their rowid as id, so stored artifacts,
+    # predictions and incremental rowid marks stay valid.
+    create_tables(conn, "_v2")
+    features = ", ".join(FEATURES)
+    casts = ", ".join(f"CAST({name} AS REAL)" for name in FEATURES)
+    conn.execute(f"INSERT INTO Wines_v2 (id, {features}, category) "
+                 f"SELECT rowid, {casts}, CAST(category AS INTEGER) FROM Wines")
+    # the oldest databases have no Predictions or WineStats table, ensure_stats rebuilds the statistics then
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if "Predictions" in tables:
+        conn.execute("INSERT INTO Predictions_v2 SELECT wine_id, CAST(category AS INTEGER) FROM Predictions")
+    if "WineStats" in tables:
+        conn.execute("INSERT INTO WineStats_v2 SELECT CAST(category AS INTEGER), feature, n, total, total_sq, "
+                     "mean, m2 FROM WineStats")
+    for table in ("Wines", "Predictions", "WineStats"):
+        if table in tables:
+            conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_v2 RENAME TO {table}")
+
+
+def create_bins(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS WineBinSteps (
+                                   feature TEXT PRIMARY KEY,
+                                   step REAL NOT NULL,
+                                   rows INTEGER NOT NULL) STRICT
+                                   ''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS WineBins (
+                                   feature TEXT NOT NULL,
+                                   category INTEGER NOT NULL,
+                                   bin INTEGER NOT NULL,
+                                   n INTEGER NOT NULL,
+                                   PRIMARY KEY (feature, category, bin)) WITHOUT ROWID, STRICT
+                                   ''')
+
+
+def migrate_v3(conn):
+    # the bins start empty, DbSQL.ensure_bins fills them with one pass over Wines
+    create_bins(conn)
+
+
+MIGRATIONS = {2: migrate_v2, 3: migrate_v3}
+
+
+def page_filter(category=None, after=None, order="rowid", descending=False):
+    check_column(order)
+    conditions = []
+    params = []
+    if category is not None:
+        conditions.append("category = ?")
+        params.append(category)
+    if after is not None:
+        # keyset pagination: continue after the (sort value, rowid) of the last row shown
+        conditions.append(f"({order}, rowid) {'<' if descending else '>'} (?, ?)")
+        params.extend(after)
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+def page_order(order, descending):
+    direction = "DESC" if descending else "ASC"
+    return f"ORDER BY {order} {direction}, rowid {direction}"
+
+
+def update_stats(conn, rows):
+    if not rows:
+        return
+    X = np.array([row[:-1] for row in rows], dtype=np.float64)
+    y = np.array([row[-1] for row in rows], dtype=np.int64)
+    if np.isinf(X).any():
+        raise ValueError("Feature values must be finite")
+    merge_stats(conn, X, y)
+    merge_bins(conn, X, y)
+
+
+def merge_stats(conn, X, y):
+    for category in np.unique(y):
+        batch = X[y == category]
+        # NULL features arrive as NaN and are left out of that feature's count, as in WineBins
+        present = ~np.isnan(batch)
+        counts_b = present.sum(axis=0)
+        batch = np.where(present, batch, 0.0)
+        mean_b = batch.sum(axis=0) / np.maximum(counts_b, 1)
+        m2_b = (np.where(present, batch - mean_b, 0.0) ** 2).sum(axis=0)
+        total_b = batch.sum(axis=0)
+        total_sq_b = (batch ** 2).sum(axis=0)
+        current = {row[0]: row[1:] for row in
+                   conn.execute("SELECT feature, n, total, total_sq, mean, m2 FROM WineStats WHERE category = ?",
+                                (int(category),))}
+        merged = []
+        for i, feature in enumerate(FEATURES):
+            n_b = int(counts_b[i])
+            if not n_b:
+                continue
+            n_a, total_a, total_sq_a, mean_a, m2_a = current.get(feature, (0, 0.0, 0.0, 0.0, 0.0))
+            n = n_a + n_b
+            # Chan et al. pairwise update keeps the variance accurate for large counts
+            delta = mean_b[i] - mean_a
+            mean = mean_a + delta * n_b / n
+            m2 = m2_a + m2_b[i] + delta * delta * n_a * n_b / n
+            merged.append((int(category), feature, n, total_a + total_b[i], total_sq_a + total_sq_b[i], mean, m2))
+        conn.executemany("INSERT OR REPLACE INTO WineStats VALUES(?, ?, ?, ?, ?, ?, ?)", merged)
+
+
+def set_bin_steps(conn):
+    # widths come from the spread in WineStats, so later rows merge into the same bins
+    conn.execute("DELETE FROM WineBins")
+    conn.execute("DELETE FROM WineBinSteps")
+    steps = []
+    for feature, n, total, total_sq in conn.execute("SELECT feature, Sum(n), Sum(total), Sum(total_sq) "
+                                                     "FROM WineStats GROUP BY feature"):
+        std = np.sqrt(max(total_sq / n - (total / n) ** 2, 0.0)) if n else 0.0
+        steps.append((feature, 8.0 * std / FINE_BINS or 1.0, n))
+    conn.executemany("INSERT INTO WineBinSteps VALUES(?, ?, ?)", steps)
+
+
+def rebin(conn, chunk_size=CHUNK_SIZE):
+    set_bin_steps(conn)
+    cursor = conn.execute(SELECT_SQL)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        add_bins(conn, np.array([row[:-1] for row in rows], dtype=np.float64),
+                 np.array([row[-1] for row in rows], dtype=np.int64))
+
+
+def merge_bins(conn, X, y):
+    # runs after merge_stats, so WineStats already counts the rows being merged
+    steps_rows = conn.execute("SELECT Min(rows) FROM WineBinSteps").fetchone()[0]
+    total = conn.execute("SELECT Coalesce(Sum(n), 0) FROM WineStats WHERE feature = ?", (FEATURES[0],)).fetchone()[0]
+    if steps_rows is None or (steps_rows < BIN_STEP_ROWS and total >= 2 * steps_rows):
+        # widths from a handful of rows are useless, derive them again while the table is still small
+        rebin(conn)
+        return
+    add_bins(conn, X, y)
+
+
+def add_bins(conn, X, y):
+    steps = dict(conn.execute("SELECT feature, step FROM WineBinSteps"))
+    categories, labels = np.unique(y, return_inverse=True)
+    rows = []
+    for i, feature in enumerate(FEATURES):
+        keep = ~np.isnan(X[:, i])
+        if not keep.any():
+            continue
+        bins = np.floor(np.clip(X[keep, i] / steps.get(feature, 1.0), -MAX_BIN, MAX_BIN)).astype(np.int64)
+        # count the (bin, category) pairs that occur, however far apart the bins are
+        keys, counts = np.unique(bins * len(categories) + labels[keep], return_counts=True)
+        rows.extend((feature, int(categories[key % len(categories)]), int(key // len(categories)), int(count))
+                    for key, count in zip(keys, counts))
+    conn.executemany("INSERT INTO WineBins VALUES(?, ?, ?, ?) ON CONFLICT(feature, category, bin) "
+                     "DO UPDATE SET n = n + excluded.n", rows)
+
+
+def merge_feature_stats(values, X):
+    merged = dict(values)
+    for i, name in enumerate(FEATURES):
+        column = X[:, i][~np.isnan(X[:, i])]
+        if not len(column):
+            continue
+        count_b = len(column)
+        mean_b = float(column.mean())
+        mean_sq_b = float((column * column).mean())
+        stats = values.get(name)
+        if stats is None:
+            merged[name] = {"count": count_b, "min": float(column.min()), "max": float(column.max()),
+                            "mean": mean_b, "var": max(mean_sq_b - mean_b * mean_b, 0.0)}
+            continue
+        count = stats["count"] + count_b
+        mean = (stats["count"] * stats["mean"] + count_b * mean_b) / count
+        mean_sq = (stats["count"] * (stats["var"] + stats["mean"] ** 2) + count_b * mean_sq_b) / count
+        merged[name] = {"count": count, "min": min(stats["min"], float(column.min())),
+                        "max": max(stats["max"], float(column.max())), "mean": mean,
+                        "var": max(mean_sq - mean * mean, 0.0)}
+    return merged
+
+
+@instrument.instrument_class("dbsql")
 class DbSQL:
 
     def __init__(self, databasename, filename):
         self.databasename = databasename
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._names = None
+        self.aggregates = {}
         self.create()
         self.read_from_file(filename)
+        self.ensure_stats()
+        self.ensure_bins()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_local", "_connections", "_lock"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+        return conn
+
+    def connect(self):
+        conn = sqlite3.connect(self.databasename, isolation_level=None, check_same_thread=False,
+                               timeout=30, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self._local.conn = conn
+        self._local.depth = 0
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        depth = self._local.depth
+        if depth == 0:
+            conn.execute("BEGIN")
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0 and conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            conn.execute("COMMIT")
+
+    def release(self):
+        # gives back the calling thread's connection, for short-lived threads that would otherwise leave it open
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+        self._local.conn = None
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
 
     def create(self):
         try:
-            conn = sqlite3.connect(self.databasename)
-            cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS Wines (
-                                               alcohol REAL,
-                                               malic_acid REAL,
-                                               ash REAL,
-                                               alcalinity_of_ash REAL,
-                                               magnesium REAL,
-                                               total_phenols REAL,
-                                               flavanoids REAL,
-                                               nonflavanoid_phenols REAL,
-                                               proanthocyanins REAL,
-                                               color_intensity REAL,
-                                               hue REAL,
-                                               diluted REAL,
-                                               proline REAL,
-                                               category TEXT)
-                                               ''')
-            conn.commit()
-        except sqlite3.Error as e:
+            with self.transaction() as conn:
+                version = self.migrate(conn)
+                if version == 0:
+                    create_tables(conn)
+                    create_bins(conn)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_wines_category ON Wines(category)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_wines_created_at ON Wines(created_at)")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        except (sqlite3.Error, ValueError) as e:
             print(f"Error: {e}")
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+        self._names = None
+
+    def migrate(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{self.databasename} uses schema version {version}, newer than {SCHEMA_VERSION}")
+        if version == 0 and conn.execute("SELECT Count(*) FROM sqlite_master WHERE type = 'table' "
+                                         "AND name = 'Wines'").fetchone()[0]:
+            version = 1
+        if 0 < version < SCHEMA_VERSION:
+            start = time.perf_counter()
+            for target in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[target](conn)
+            print(f"Migrated {self.databasename} from schema {version} to {SCHEMA_VERSION} "
+                  f"in {time.perf_counter() - start:.2f}s")
+        return version
 
     def fetch_data(self):
         try:
-            conn = sqlite3.connect(self.databasename)
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM Wines")
-            res = cursor.fetchall()
-            return res
+            return self.connection().execute(SELECT_SQL).fetchall()
         except sqlite3.Error as e:
             print(f"Error: {e}")
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+
+    def fetch_arrays(self, after=0, chunk_size=CHUNK_SIZE):
+        with self.transaction() as conn:
+            count, last = conn.execute("SELECT Count(*), Max(rowid) FROM Wines WHERE rowid > ?", (after,)).fetchone()
+            X = np.empty((count, len(FEATURES)), dtype=np.float64)
+            y = np.empty(count, dtype=np.int64)
+            cursor = conn.execute(SELECT_AFTER_SQL, (after,))
+            pos = 0
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                end = pos + len(rows)
+                X[pos:end] = [row[:-1] for row in rows]
+                y[pos:end] = [row[-1] for row in rows]
+                pos = end
+        return X, y, last or after
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE, after=0, upto=MAX_ROWID):
+        conn = self.connection()
+        while True:
+            rows = conn.execute(SELECT_CHUNK_SQL, (after, upto, chunk_size)).fetchall()
+            if not rows:
+                return
+            rowids = np.array([row[0] for row in rows], dtype=np.int64)
+            X = np.array([row[1:-1] for row in rows], dtype=np.float64)
+            y = np.array([row[-1] for row in rows], dtype=np.int64)
+            after = int(rowids[-1])
+            yield rowids, X, y
+
+    def write_predictions(self, rowids, labels):
+        with self.transaction() as conn:
+            conn.executemany(PREDICTION_SQL, zip(np.asarray(rowids).tolist(), np.asarray(labels).tolist()))
+
+    def count(self, upto=None):
+        if upto is None:
+            return self.connection().execute("SELECT Count(*) FROM Wines").fetchone()[0]
+        return self.connection().execute("SELECT Count(*) FROM Wines WHERE rowid <= ?", (upto,)).fetchone()[0]
+
+    def since(self, timestamp):
+        # rowid to pass as `after` to read the rows inserted at or after timestamp, one seek on idx_wines_created_at
+        row = self.connection().execute("SELECT rowid FROM Wines WHERE created_at >= ? ORDER BY created_at LIMIT 1",
+                                        (timestamp,)).fetchone()
+        if row is None:
+            return self.connection().execute("SELECT Coalesce(Max(rowid), 0) FROM Wines").fetchone()[0]
+        return row[0] - 1
+
+    def ensure_index(self, *columns):
+        for column in columns:
+            check_column(column)
+        name = "idx_wines_" + "_".join(columns)
+        with self.transaction() as conn:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON Wines({', '.join(columns)})")
+
+    def categories(self):
+        return [row[0] for row in self.connection().execute("SELECT DISTINCT category FROM Wines ORDER BY category")]
+
+    def count_where(self, category=None, after=0):
+        where, params = page_filter(category)
+        where = f"{where} AND rowid > ?" if where else "WHERE rowid > ?"
+        return self.connection().execute(f"SELECT Count(*) FROM Wines {where}", params + [after]).fetchone()[0]
+
+    def version(self):
+        # rows are only appended and rowids only grow, so the last rowid doubles as the change feed position:
+        # a consumer keeps the version it has seen and reads rowid > version to catch up, whoever inserted them
+        return self.connection().execute("SELECT Coalesce(Max(rowid), 0) FROM Wines").fetchone()[0]
+
+    def fetch_page(self, after=None, limit=100, order="rowid", descending=False, category=None):
+        where, params = page_filter(category, after, order, descending)
+        sql = (f"SELECT {order}, rowid, {', '.join(COLUMNS)} FROM Wines {where} "
+               f"{page_order(order, descending)} LIMIT ?")
+        return self.connection().execute(sql, params + [limit]).fetchall()
+
+    def page_key(self, offset, order="rowid", descending=False, category=None):
+        where, params = page_filter(category, None, order, descending)
+        sql = f"SELECT {order}, rowid FROM Wines {where} {page_order(order, descending)} LIMIT 1 OFFSET ?"
+        return self.connection().execute(sql, params + [offset]).fetchone()
 
     def read_from_file(self, file):
-        conn = sqlite3.connect(self.databasename)
-        cursor = conn.cursor()
-        cursor.execute("SELECT Count(*) FROM Wines")
-        count = cursor.fetchall()[0][0]
-        
-        if count <= 0:
-            with open(file) as file_object:
-                for line in file_object:
-                    data = line.strip()
-                    data = data.split(",")
-                    for i in range(len(data)-1):
-                        x = data[i]
-                        data[i] = float(data[i+1])
-                        data[i+1] = x
-                    params = tuple(data)
-                    sql = "INSERT INTO Wines VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                    cursor.execute(sql, params)
-                    conn.commit()
-        cursor.close()
-        conn.close()
+        if self.count() <= 0:
+            self.bulk_load(file)
+
+    def bulk_load(self, file, chunk_size=CHUNK_SIZE):
+        total = 0
+        start = time.perf_counter()
+        try:
+            with self.transaction() as conn:
+                with open_data_file(file) as file_object:
+                    for chunk in read_chunks(file_object, chunk_size):
+                        conn.executemany(INSERT_SQL, chunk)
+                        update_stats(conn, chunk)
+                        total += len(chunk)
+                        instrument.count("dbsql.rows_loaded", len(chunk))
+        except (sqlite3.Error, ValueError) as e:
+            total = 0
+            print(f"Error: {e}")
+
+        elapsed = time.perf_counter() - start
+        rate = total / elapsed if elapsed > 0 else 0
+        print(f"Loaded {total} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+        return total
 
     def insert_data(self, data):
-        conn = sqlite3.connect(self.databasename)
-        cursor = conn.cursor()
-
-        params = tuple(data)
-        sql = "INSERT INTO Wines VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        cursor.execute(sql, params)
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute(INSERT_SQL, tuple(data))
+            update_stats(conn, [data])
+
+    def insert_many(self, rows):
+        rows = [tuple(row) for row in rows]
+        with self.transaction() as conn:
+            conn.executemany(INSERT_SQL, rows)
+            update_stats(conn, rows)
+        instrument.count("dbsql.rows_inserted", len(rows))
+        return len(rows)
+
+    def ensure_stats(self):
+        conn = self.connection()
+        if conn.execute("SELECT Count(*) FROM WineStats").fetchone()[0] == 0 and self.count() > 0:
+            self.rebuild_stats()
+
+    def rebuild_stats(self, chunk_size=CHUNK_SIZE):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM WineStats")
+            for _, X, y in self.iter_chunks(chunk_size):
+                merge_stats(conn, X, y)
+
+    def ensure_bins(self):
+        conn = self.connection()
+        if conn.execute("SELECT Count(*) FROM WineBins").fetchone()[0] == 0 and self.count() > 0:
+            self.rebuild_bins()
+
+    def rebuild_bins(self, chunk_size=CHUNK_SIZE):
+        with self.transaction() as conn:
+            rebin(conn, chunk_size)
+
+    def fetch_stats(self):
+        # the statistics and the rowid they cover come from one snapshot
+        with self.transaction() as conn:
+            rows = conn.execute(STATS_SQL).fetchall()
+            rowid = conn.execute("SELECT Max(rowid) FROM Wines").fetchone()[0] or 0
+        categories = sorted({row[0] for row in rows})
+        shape = (len(categories), len(FEATURES))
+        stats = {name: np.zeros(shape) for name in ("n", "total", "total_sq", "mean", "m2")}
+        feature_index = {name: i for i, name in enumerate(FEATURES)}
+        category_index = {category: i for i, category in enumerate(categories)}
+        for category, feature, *values in rows:
+            for name, value in zip(("n", "total", "total_sq", "mean", "m2"), values):
+                stats[name][category_index[category], feature_index[feature]] = value
+        stats["categories"] = np.array(categories)
+        stats["rowid"] = rowid
+        return stats
+
+    def aggregate(self, key, compute, update=None):
+        entry = self.aggregates.get(key)
+        if entry is not None:
+            version, value = entry
+            latest = self.version()
+            if latest == version:
+                return value
+            entry = None
+            if update is not None and latest - version <= AGGREGATE_DELTA_ROWS:
+                X, y, latest = self.fetch_arrays(after=version)
+                value = update(value, X, y)
+                if value is not None:
+                    entry = (latest, value)
+        if entry is None:
+            # the version and the query read the same snapshot, so later deltas are never counted twice
+            with self.transaction():
+                entry = (self.version(), compute())
+        self.aggregates[key] = entry
+        return entry[1]
+
+    def category_counts(self):
+        def compute():
+            rows = self.connection().execute("SELECT category, Count(*) FROM Wines GROUP BY category "
+                                             "ORDER BY category")
+            return dict(rows.fetchall())
+
+        def update(counts, X, y):
+            counts = dict(counts)
+            for category, count in zip(*np.unique(y, return_counts=True)):
+                counts[int(category)] = counts.get(int(category), 0) + int(count)
+            return dict(sorted(counts.items()))
+        return self.aggregate(("counts",), compute, update)
+
+    def feature_stats(self, by_category=False):
+        def compute():
+            columns = ", ".join(f"Count({name}), Min({name}), Max({name}), Avg({name}), Avg({name} * {name})"
+                                for name in FEATURES)
+            group = "GROUP BY category ORDER BY category" if by_category else ""
+            stats = {}
+            for row in self.connection().execute(f"SELECT category, {columns} FROM Wines {group}"):
+                if row[1] == 0:
+                    continue
+                values = {}
+                for i, name in enumerate(FEATURES):
+                    count, low, high, mean, mean_sq = row[1 + 5 * i:6 + 5 * i]
+                    values[name] = {"count": count, "min": low, "max": high, "mean": mean,
+                                    "var": max(mean_sq - mean * mean, 0.0)}
+                stats[row[0] if by_category else None] = values
+            return stats if by_category else stats.get(None, {})
+
+        def update(stats, X, y):
+            if not by_category:
+                return merge_feature_stats(stats, X)
+            stats = dict(stats)
+            for category in np.unique(y):
+                stats[int(category)] = merge_feature_stats(stats.get(int(category), {}), X[y == category])
+            return dict(sorted(stats.items()))
+        return self.aggregate(("stats", by_category), compute, update)
+
+    def histogram(self, column, bins=20, by_category=False):
+        # the range comes from feature_stats and the incremental update reads feature columns only
+        if column not in FEATURES:
+            raise ValueError(f"Unknown feature {column}")
+
+        def compute():
+            stats = self.feature_stats()[column]
+            low, high = stats["min"], stats["max"]
+            width = (high - low) / bins or 1.0
+            edges = np.linspace(low, high, bins + 1) if high > low else np.array([low, low + width])
+            group = "category, " if by_category else ""
+            rows = self.connection().execute(
+                f"SELECT {group}Min(CAST(({column} - ?) / ? AS INTEGER), ?) AS bin, Count(*) FROM Wines "
+                f"WHERE {column} IS NOT NULL GROUP BY {group}bin", (low, width, len(edges) - 2))
+            counts = {}
+            for row in rows:
+                key = row[0] if by_category else None
+                counts.setdefault(key, np.zeros(len(edges) - 1, dtype=np.int64))[row[-2]] = row[-1]
+            return edges, counts if by_category else counts.get(None, np.zeros(len(edges) - 1, dtype=np.int64))
+
+        def update(histogram, X, y):
+            edges, counts = histogram
+            values = X[:, FEATURES.index(column)]
+            keep = ~np.isnan(values)
+            values, labels = values[keep], y[keep]
+            if len(values) and (values.min() < edges[0] or values.max() > edges[-1]):
+                # the new rows widen the range, the bins have to be recomputed
+                return None
+            width = (edges[-1] - edges[0]) / bins if len(edges) == bins + 1 else 1.0
+            indices = np.minimum(((values - edges[0]) / width).astype(np.int64), len(edges) - 2)
+            if not by_category:
+                return edges, counts + np.bincount(indices, minlength=len(edges) - 1)
+            counts = {category: bin_counts.copy() for category, bin_counts in counts.items()}
+            for category in np.unique(labels):
+                counts.setdefault(int(category), np.zeros(len(edges) - 1, dtype=np.int64))
+                counts[int(category)] += np.bincount(indices[labels == category], minlength=len(edges) - 1)
+            return edges, counts
+        return self.aggregate(("histogram", column, bins, by_category), compute,
+                              update if column in FEATURES else None)
+
+    def binned_histogram(self, column, bins=20, by_category=False):
+        if column not in FEATURES:
+            raise ValueError(f"Unknown feature {column}")
+
+        def compute():
+            # reads the pre-binned counts kept by every insert, no pass over Wines whatever its size
+            conn = self.connection()
+            step = conn.execute("SELECT step FROM WineBinSteps WHERE feature = ?", (column,)).fetchone()
+            rows = conn.execute("SELECT category, bin, n FROM WineBins WHERE feature = ?", (column,)).fetchall()
+            if step is None or not rows:
+                return np.array([0.0, 1.0]), {} if by_category else np.zeros(1, dtype=np.int64)
+            data = np.array(rows, dtype=np.int64)
+            first = data[:, 1].min()
+            span = data[:, 1].max() - first + 1
+            # whole fine bins per output bin, so every count lands in exactly one output bin
+            width = -(-span // bins)
+            count = -(-span // width)
+            edges = (first + width * np.arange(count + 1)) * step[0]
+            index = (data[:, 1] - first) // width
+            if not by_category:
+                return edges, np.bincount(index, data[:, 2], count).astype(np.int64)
+            return edges, {int(category): np.bincount(index[data[:, 0] == category], data[data[:, 0] == category, 2],
+                                                      count).astype(np.int64)
+                           for category in np.unique(data[:, 0])}
+        return self.aggregate(("binned", column, bins, by_category), compute)
 
     def fetch_names(self):
-        conn = sqlite3.connect(self.databasename)
-        cursor = conn.execute("SELECT * FROM Wines")
-        names = [description[0] for description in cursor.description]
-        cursor.close()
-        conn.close()
-        return names
+        if self._names is None:
+            rows = self.connection().execute("PRAGMA table_info(Wines)").fetchall()
+            # the table also carries id and created_at, callers only want the data columns
+            self._names = [row[1] for row in rows if row[1] in COLUMNS]
+        return list(self._names)
+
+
+class WriteBuffer:
+
+    def __init__(self, db, max_rows=1000, max_delay=0.5, on_flush=None):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self._rows = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, row):
+        self.extend([row])
+
+    def extend(self, rows):
+        with self._lock:
+            self._rows.extend(tuple(row) for row in rows)
+            full = len(self._rows) >= self.max_rows
+            if not full and self._timer is None and self._rows:
+                self._timer = threading.Timer(self.max_delay, self.flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if rows:
+            try:
+                self.db.insert_many(rows)
+            except BaseException:
+                # the batch is rolled back as a whole, keep its rows ahead of anything added meanwhile
+                with self._lock:
+                    self._rows[:0] = rows
+                raise
+            if self.on_flush is not None:
+                self.on_flush(rows)
+        return len(rows)
+
+    def flush_later(self):
+        # every timer runs on a new thread, so its connection is closed once the rows are written
+        try:
+            self.flush()
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Error: {e}")
+        finally:
+            self.db.release()
+
+    def close(self):
+        self.flush()
+
+
+class Reservoir:
+
+    def __init__(self, db, size=5000, seed=0, max_rounds=20):
+        self.db = db
+        self.size = size
+        self.max_rounds = max_rounds
+        self.rng = np.random.default_rng(seed)
+        self.X = np.empty((0, len(FEATURES)))
+        self.y = np.empty(0, dtype=np.int64)
+        self.seen = 0
+        self.version = None
+
+    def update(self):
+        version = self.db.version()
+        if self.version is None or version - self.version > AGGREGATE_DELTA_ROWS:
+            self.fill()
+        elif version > self.version:
+            X, y, self.version = self.db.fetch_arrays(after=self.version)
+            self.add(X, y)
+        return self.X, self.y
+
+    def fill(self):
+        with self.db.transaction() as conn:
+            count, first, last = conn.execute("SELECT Count(*), Min(rowid), Max(rowid) FROM Wines").fetchone()
+            self.seen = count
+            self.version = last or 0
+            if count <= self.size:
+                self.X, self.y, _ = self.db.fetch_arrays()
+                return
+            # uniform rowids from the key range, a lookup per row instead of a scan of the whole table
+            chosen = np.empty(0, dtype=np.int64)
+            rows = []
+            for _ in range(self.max_rounds):
+                need = self.size - len(chosen)
+                if need <= 0:
+                    break
+                candidates = np.setdiff1d(self.rng.integers(first, last + 1, 2 * need), chosen)
+                found = conn.execute(f"SELECT rowid, {', '.join(COLUMNS)} FROM Wines "
+                                     f"WHERE rowid IN (SELECT value FROM json_each(?))",
+                                     (json.dumps(candidates.tolist()),)).fetchall()
+                found = [found[i] for i in self.rng.permutation(len(found))[:need]]
+                chosen = np.union1d(chosen, [row[0] for row in found])
+                rows.extend(found)
+        self.X = np.array([row[1:-1] for row in rows], dtype=np.float64).reshape(-1, len(FEATURES))
+        self.y = np.array([row[-1] for row in rows], dtype=np.int64)
+
+    def add(self, X, y):
+        # Algorithm R: after n rows every one of them is in the sample with probability size / n
+        free = min(max(self.size - len(self.y), 0), len(y))
+        if free:
+            self.X = np.concatenate([self.X, X[:free]])
+            self.y = np.concatenate([self.y, y[:free]])
+            self.seen += free
+        X, y = X[free:], y[free:]
+        positions = self.seen + np.arange(1, len(y) + 1)
+        slots = (self.rng.random(len(y)) * positions).astype(np.int64)
+        for row in np.flatnonzero(slots < self.size):
+            self.X[slots[row]] = X[row]
+            self.y[slots[row]] = y[row]
+        self.seen += len(y)
+
+
+@instrument.instrument_class("pager")
+class Pager:
+
+    def __init__(self, db, order="rowid", descending=False, category=None, page_size=100, cache_pages=16):
+        self.db = db
+        self.order = order
+        self.descending = descending
+        self.category = category
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.version = db.version()
+        self.total = db.count_where(category)
+        self.keys = {0: None}
+        self.pages = OrderedDict()
+
+    def update(self):
+        version = self.db.version()
+        if version == self.version:
+            return False
+        # new rows always have larger rowids, so only they need counting
+        old_total = self.total
+        self.total += self.db.count_where(self.category, self.version)
+        self.version = version
+        if self.order == "rowid" and not self.descending:
+            # they land after every cached row, only the last partial page and its successors change
+            last = old_total // self.page_size
+            for index in [index for index in self.pages if index >= last]:
+                del self.pages[index]
+            for index in [index for index in self.keys if index > last]:
+                del self.keys[index]
+        else:
+            self.pages.clear()
+            self.keys = {0: None}
+        return True
+
+    def page(self, index):
+        if index in self.pages:
+            self.pages.move_to_end(index)
+            return self.pages[index]
+        if index not in self.keys:
+            # no neighbouring page was read, find where the page starts from the index
+            self.keys[index] = self.db.page_key(index * self.page_size - 1, self.order, self.descending,
+                                                self.category)
+        rows = self.db.fetch_page(self.keys[index], self.page_size, self.order, self.descending, self.category)
+        if rows:
+            self.keys[index + 1] = rows[-1][:2]
+        page = [row[2:] for row in rows]
+        self.pages[index] = page
+        if len(self.pages) > self.cache_pages:
+            self.pages.popitem(last=False)
+        return page
+
+    def rows(self, offset, count):
+        rows = []
+        index = offset // self.page_size
+        skip = offset - index * self.page_size
+        while len(rows) < count and index * self.page_size < self.total:
+            page = self.page(index)
+            if not page:
+                break
+            rows.extend(page[skip:skip + count - len(rows)])
+            skip = 0
+            index += 1
+        return rows
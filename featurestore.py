@@ -0,0 +1,69 @@
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import dbsql
+
+META_FILE = "meta.json"
+LABEL_FILE = "category.npy"
+
+
+class FeatureStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.features = self.meta["features"]
+        self.rows = self.meta["rows"]
+        self.classes = np.array(self.meta["classes"])
+        self.columns = [self.column(name) for name in self.features]
+        self.labels = np.load(os.path.join(directory, LABEL_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return self.rows
+
+    @classmethod
+    def export(cls, db, directory, chunk_size=dbsql.CHUNK_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        with db.transaction() as conn:
+            rows, last = conn.execute("SELECT Count(*), Max(rowid) FROM Wines").fetchone()
+            columns = [open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=np.float64,
+                                   shape=(rows,)) for name in dbsql.FEATURES]
+            labels = open_memmap(os.path.join(directory, LABEL_FILE), mode="w+", dtype=np.int64,
+                                 shape=(rows,))
+            classes = set()
+            pos = 0
+            for _, X, y in db.iter_chunks(chunk_size):
+                end = pos + len(y)
+                for i, column in enumerate(columns):
+                    column[pos:end] = X[:, i]
+                labels[pos:end] = y
+                classes.update(y.tolist())
+                pos = end
+        for column in columns:
+            column.flush()
+        labels.flush()
+        del columns, labels
+
+        meta = {"features": list(dbsql.FEATURES), "rows": rows, "last_rowid": last or 0,
+                "classes": sorted(classes)}
+        with open(os.path.join(directory, META_FILE), "w") as f:
+            json.dump(meta, f)
+        return cls(directory)
+
+    def column(self, name):
+        return np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r")
+
+    def chunk(self, start, end):
+        X = np.empty((end - start, len(self.columns)), dtype=np.float64)
+        for i, column in enumerate(self.columns):
+            X[:, i] = column[start:end]
+        return X, np.asarray(self.labels[start:end])
+
+    def iter_chunks(self, chunk_size=dbsql.CHUNK_SIZE, start=0, end=None):
+        end = self.rows if end is None else end
+        for pos in range(start, end, chunk_size):
+            yield self.chunk(pos, min(pos + chunk_size, end))
@@ -0,0 +1,155 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# WINE_PROFILE=1 turns instrumentation on; without it the decorators return the functions untouched
+ENABLED = os.environ.get("WINE_PROFILE", "") not in ("", "0")
+MEMORY = ENABLED and os.environ.get("WINE_PROFILE_MEMORY", "") not in ("", "0")
+OUTPUT = os.environ.get("WINE_PROFILE_OUTPUT", "profile.json")
+CPROFILE_DIR = os.environ.get("WINE_PROFILE_CPROFILE", "") if ENABLED else ""
+
+timers = {}
+counters = {}
+_lock = threading.Lock()
+_profiled = {}
+_frames = []
+
+
+def record(name, seconds, peak=None):
+    with _lock:
+        timer = timers.get(name)
+        if timer is None:
+            timer = timers[name] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_bytes": 0}
+        timer["calls"] += 1
+        timer["seconds"] += seconds
+        timer["max_seconds"] = max(timer["max_seconds"], seconds)
+        if peak is not None:
+            timer["peak_bytes"] = max(timer["peak_bytes"], peak)
+
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def wrap(name, func, action=False):
+    if not ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        frame = memory_start() if MEMORY else None
+        profiler = None
+        if action and CPROFILE_DIR:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another action is already being profiled
+                profiler = None
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                dump(name, profiler)
+            record(name, seconds, memory_stop(frame) if frame is not None else None)
+
+    return wrapper
+
+
+def memory_start():
+    # tracemalloc has one peak for the process, every open call keeps its own peak and baseline so a nested call
+    # resetting it does not lose what the outer call already reached
+    import tracemalloc
+    with _lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in _frames:
+            frame[1] = max(frame[1], peak)
+        tracemalloc.reset_peak()
+        frame = [current, current]
+        _frames.append(frame)
+    return frame
+
+
+def memory_stop(frame):
+    import tracemalloc
+    with _lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        _frames[:] = [other for other in _frames if other is not frame]
+        for other in _frames:
+            other[1] = max(other[1], peak)
+        return max(frame[1], peak) - frame[0]
+
+
+def timed(name=None, action=False):
+    def decorator(func):
+        return wrap(name or func.__qualname__, func, action)
+    return decorator
+
+
+def instrument_class(prefix, action=False, skip=("transaction",)):
+    def decorator(cls):
+        if not ENABLED:
+            return cls
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_") or attr in skip or not callable(value):
+                continue
+            if isinstance(value, (staticmethod, classmethod, type)):
+                continue
+            setattr(cls, attr, wrap(f"{prefix}.{attr}", value, action))
+        return cls
+    return decorator
+
+
+def dump(name, profiler):
+    os.makedirs(CPROFILE_DIR, exist_ok=True)
+    with _lock:
+        _profiled[name] = _profiled.get(name, 0) + 1
+        number = _profiled[name]
+    profiler.dump_stats(os.path.join(CPROFILE_DIR, f"{name}-{number}.prof"))
+
+
+def snapshot():
+    with _lock:
+        return {"timers": {name: dict(timer) for name, timer in timers.items()}, "counters": dict(counters)}
+
+
+def prometheus(data):
+    # the exposition format wants every sample of a family right after its TYPE line
+    lines = []
+    for metric, kind, field, fmt in (("wine_calls_total", "counter", "calls", "d"),
+                                     ("wine_call_seconds_total", "counter", "seconds", ".9f"),
+                                     ("wine_call_seconds_max", "gauge", "max_seconds", ".9f"),
+                                     ("wine_call_peak_bytes", "gauge", "peak_bytes", "d")):
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, timer in sorted(data["timers"].items()):
+            lines.append(f'{metric}{{name="{name}"}} {timer[field]:{fmt}}')
+    lines.append("# TYPE wine_events_total counter")
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f'wine_events_total{{name="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def export(path=None):
+    path = path or OUTPUT
+    data = snapshot()
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+    with open(os.path.splitext(path)[0] + ".prom", "w") as f:
+        f.write(prometheus(data))
+    return path
+
+
+if ENABLED:
+    atexit.register(export)
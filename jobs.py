@@ -0,0 +1,121 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+
+POLL_INTERVAL = 100
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.progress = 0.0
+        self.message = ""
+        self.future = None
+        self.on_done = []
+        self.on_error = []
+        self.on_progress = []
+        self._reported = None
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled(self.key)
+
+    def report(self, progress, message=""):
+        self.check()
+        self.progress = progress
+        self.message = message
+
+    def run(self):
+        self.check()
+        return self.func(self, *self.args)
+
+
+class Scheduler:
+
+    def __init__(self, root, workers=1, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.jobs = {}
+        self._polling = False
+
+    def submit(self, key, func, *args, on_done=None, on_error=None, on_progress=None):
+        job = self.jobs.get(key)
+        if job is None or job.cancelled:
+            name = key[0] if isinstance(key, tuple) else key
+            job = Job(key, instrument.wrap(f"job.{name}", func, action=True), args)
+            job.future = self.executor.submit(job.run)
+            self.jobs[key] = job
+        # a click while the same job is queued or running only adds its callbacks
+        if on_done is not None:
+            job.on_done.append(on_done)
+        if on_error is not None:
+            job.on_error.append(on_error)
+        if on_progress is not None:
+            job.on_progress.append(on_progress)
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.interval, self.poll)
+        return job
+
+    def cancel(self, key):
+        job = self.jobs.get(key)
+        if job is not None:
+            job.cancel()
+
+    def running(self, key):
+        return key in self.jobs
+
+    def poll(self):
+        for key, job in list(self.jobs.items()):
+            state = (job.progress, job.message)
+            if state != job._reported:
+                job._reported = state
+                for callback in job.on_progress:
+                    callback(job.progress, job.message)
+            if not job.future.done():
+                continue
+
+            if self.jobs.get(key) is job:
+                del self.jobs[key]
+            if job.future.cancelled() or job.cancelled:
+                continue
+            error = job.future.exception()
+            if error is None:
+                for callback in job.on_done:
+                    callback(job.future.result())
+            elif isinstance(error, JobCancelled):
+                continue
+            elif job.on_error:
+                for callback in job.on_error:
+                    callback(error)
+            else:
+                print(f"Error: {error}")
+
+        if self.jobs:
+            self.root.after(self.interval, self.poll)
+        else:
+            self._polling = False
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            job.cancel()
+        self.executor.shutdown(wait=False)
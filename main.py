@@ -1,3 +1,18 @@
-import GUI
+import argparse
 
-gui = GUI.GUI()
+parser = argparse.ArgumentParser(description="Wine recognition model")
+subparsers = parser.add_subparsers(dest="command")
+serve_parser = subparsers.add_parser("serve", help="serve predictions of a saved model over HTTP")
+serve_parser.add_argument("model", help="model file written by Save model")
+serve_parser.add_argument("--host", default="127.0.0.1")
+serve_parser.add_argument("--port", type=int, default=8080)
+args = parser.parse_args()
+
+if args.command == "serve":
+    import server
+
+    server.PredictionServer(args.model, args.host, args.port).run()
+else:
+    import GUI
+
+    gui = GUI.GUI()
@@ -1,40 +1,537 @@
 from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
 from sklearn.naive_bayes import GaussianNB
-from sklearn.model_selection import train_test_split, cross_val_score, KFold, GridSearchCV
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split, KFold, StratifiedKFold, GridSearchCV
 from sklearn.exceptions import NotFittedError
+import csv
+import functools
+import hashlib
+import itertools
+import os
+import threading
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
 import pandas as pd
+import dbsql
+import instrument
 
+ARTIFACT_VERSION = 1
+VAR_SMOOTHING_GRID = tuple(np.logspace(-15, 0, 31).tolist())
+SEARCH_CACHE_SIZE = 32
+KERNEL_BLOCK = 1024
 
+# engine name -> (estimator factory, hyperparameter grid searched by evaluate_best)
+ENGINES = {
+    "gaussian_nb": (GaussianNB, {"var_smoothing": VAR_SMOOTHING_GRID}),
+    "logistic_regression": (lambda: make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000)),
+                            {"logisticregression__C": (0.01, 0.1, 1.0, 10.0, 100.0)}),
+    "random_forest": (lambda: RandomForestClassifier(n_jobs=-1, random_state=0),
+                      {"max_depth": (None, 4, 8, 16)}),
+    "knn": (lambda: make_pipeline(StandardScaler(), KNeighborsClassifier()),
+            {"kneighborsclassifier__n_neighbors": (1, 3, 5, 9, 15)}),
+}
+
+
+def fingerprint(X, y):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((X.shape, X.dtype.str, y.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(X).data)
+    digest.update(np.ascontiguousarray(y).data)
+    return digest.hexdigest()
+
+
+def estimator_arrays(estimator, prefix):
+    classes = estimator.classes_
+    if classes.dtype == object:
+        classes = classes.astype(str)
+    return {f"{prefix}classes": classes,
+            f"{prefix}class_count": estimator.class_count_,
+            f"{prefix}class_prior": estimator.class_prior_,
+            f"{prefix}theta": estimator.theta_,
+            f"{prefix}var": estimator.var_,
+            f"{prefix}epsilon": np.float64(estimator.epsilon_),
+            f"{prefix}var_smoothing": np.float64(estimator.var_smoothing)}
+
+
+def estimator_from_arrays(arrays, prefix):
+    estimator = GaussianNB(var_smoothing=float(arrays[f"{prefix}var_smoothing"]))
+    estimator.classes_ = arrays[f"{prefix}classes"]
+    if estimator.classes_.dtype.kind == "U":
+        # files saved before categories became integers in the database
+        estimator.classes_ = estimator.classes_.astype(np.int64)
+    estimator.class_count_ = arrays[f"{prefix}class_count"]
+    estimator.class_prior_ = arrays[f"{prefix}class_prior"]
+    estimator.theta_ = arrays[f"{prefix}theta"]
+    estimator.var_ = arrays[f"{prefix}var"]
+    estimator.epsilon_ = float(arrays[f"{prefix}epsilon"])
+    estimator.n_features_in_ = estimator.theta_.shape[1]
+    return estimator
+
+
+def save_artifact(file, estimator, best, learned_rowid):
+    arrays = estimator_arrays(estimator, "model_")
+    if best is not None:
+        arrays.update(estimator_arrays(best, "best_"))
+    arrays.update({"version": np.int64(ARTIFACT_VERSION),
+                   "features": np.array(dbsql.FEATURES),
+                   "learned_rowid": np.int64(learned_rowid),
+                   "saved_at": np.float64(time.time())})
+    with open(file, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_artifact(file):
+    with np.load(file, allow_pickle=False) as arrays:
+        version = int(arrays["version"])
+        if version > ARTIFACT_VERSION:
+            raise ValueError(f"Unsupported model file version {version}")
+        estimator = estimator_from_arrays(arrays, "model_")
+        best = estimator_from_arrays(arrays, "best_") if "best_theta" in arrays else None
+        return estimator, best, int(arrays["learned_rowid"])
+
+
+def estimator_from_stats(classes, n, means, variances, var_smoothing):
+    # pooled variance of each feature over all categories, as GaussianNB uses for epsilon
+    total = n.sum()
+    pooled_mean = (n[:, None] * means).sum(axis=0) / total
+    pooled_var = ((n[:, None] * (variances + (means - pooled_mean) ** 2)).sum(axis=0)) / total
+
+    estimator = GaussianNB(var_smoothing=var_smoothing)
+    estimator.classes_ = classes
+    estimator.class_count_ = n.astype(np.float64)
+    estimator.class_prior_ = n / total
+    estimator.epsilon_ = estimator.var_smoothing * pooled_var.max()
+    estimator.theta_ = means
+    estimator.var_ = variances + estimator.epsilon_
+    estimator.n_features_in_ = means.shape[1]
+    return estimator
+
+
+def report(action, total, start):
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else 0
+    print(f"{action} {total} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+
+
+def make_estimator(engine):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}, choose one of {', '.join(ENGINES)}")
+    return ENGINES[engine][0]()
+
+
+class FastGaussianNB:
+    def __init__(self, estimator, dtype=np.float64, block=KERNEL_BLOCK):
+        if not hasattr(estimator, "classes_"):
+            raise NotFittedError("GaussianNB is not fitted yet")
+        self.dtype = np.dtype(dtype)
+        self.classes_ = estimator.classes_
+        self.n_features_in_ = estimator.theta_.shape[1]
+        self.theta = estimator.theta_.astype(self.dtype)
+        self.half_inv_var = (0.5 / estimator.var_).astype(self.dtype)
+        self.const = (np.log(estimator.class_prior_)
+                      - 0.5 * np.log(2.0 * np.pi * estimator.var_).sum(axis=1)).astype(self.dtype)
+        self.block = block
+        self.diff = np.empty((block,) + self.theta.shape, dtype=self.dtype)
+        self.jll = np.empty((block, len(self.classes_)), dtype=self.dtype)
+        self.lock = threading.Lock()
+
+    def joint_log_likelihood(self, X):
+        # writes into the preallocated buffers, callers copy what they keep
+        n = len(X)
+        diff = self.diff[:n]
+        jll = self.jll[:n]
+        np.subtract(X[:, None, :], self.theta, out=diff)
+        np.square(diff, out=diff)
+        np.multiply(diff, self.half_inv_var, out=diff)
+        np.sum(diff, axis=2, out=jll)
+        np.subtract(self.const, jll, out=jll)
+        return jll
+
+    def check(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected {self.n_features_in_} features, got {X.shape[1]}")
+        return X
+
+    def predict(self, X):
+        X = self.check(X)
+        indices = np.empty(len(X), dtype=np.intp)
+        with self.lock:
+            for start in range(0, len(X), self.block):
+                jll = self.joint_log_likelihood(X[start:start + self.block])
+                np.argmax(jll, axis=1, out=indices[start:start + len(jll)])
+        return self.classes_[indices]
+
+    def predict_proba(self, X):
+        X = self.check(X)
+        probabilities = np.empty((len(X), len(self.classes_)), dtype=self.dtype)
+        with self.lock:
+            for start in range(0, len(X), self.block):
+                probabilities[start:start + self.block] = self.joint_log_likelihood(X[start:start + self.block])
+        probabilities -= probabilities.max(axis=1, keepdims=True)
+        np.exp(probabilities, out=probabilities)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        return probabilities
+
+
+def index_dtype(n):
+    return np.int32 if n < 2 ** 31 else np.int64
+
+
+class Split:
+    def __init__(self, n, test_size=0.0, seed=0, stratify=None, n_folds=5):
+        self.n = n
+        self.test_size = test_size
+        self.seed = seed
+        self.n_folds = n_folds
+        self.stratify = stratify[:n] if stratify is not None else None
+        self.cache = {}
+        if test_size > 0:
+            indices = np.arange(n, dtype=index_dtype(n))
+            stratify = self.stratify if self.stratifiable(2) else None
+            n_test = int(np.ceil(test_size * n))
+            if stratify is not None and min(n_test, n - n_test) < len(np.unique(stratify)):
+                # a stratified split needs at least one row of every class on both sides
+                stratify = None
+            train, test = train_test_split(indices, test_size=test_size, random_state=seed, stratify=stratify)
+            # sorted indices keep the gathers sequential over the base matrix
+            self.train = np.sort(train)
+            self.test = np.sort(test)
+        else:
+            # without a test set both parts are views of the whole base matrix
+            self.train = None
+            self.test = None
+        self.fold_ids = {}
+
+    def stratifiable(self, folds, part=None):
+        if self.stratify is None:
+            return False
+        labels = self.stratify if part is None or self.train is None else self.stratify[getattr(self, part)]
+        return np.unique(labels, return_counts=True)[1].min() >= folds
+
+    def indices(self, part):
+        return self.test if part == "test" and self.test is not None else self.train
+
+    def take(self, X, y, part):
+        indices = self.indices(part)
+        if indices is None:
+            return X[:self.n], y[:self.n]
+        if part not in self.cache:
+            self.cache[part] = (X[indices], y[indices])
+        return self.cache[part]
+
+    def size(self, part):
+        indices = self.indices(part)
+        return self.n if indices is None else len(indices)
+
+    def folds(self, part="train"):
+        if part not in self.fold_ids:
+            n = self.size(part)
+            fold_ids = np.empty(n, dtype=np.int8)
+            positions = np.arange(n, dtype=index_dtype(n))
+            if self.stratifiable(self.n_folds, part):
+                labels = self.stratify if self.indices(part) is None else self.stratify[self.indices(part)]
+                splitter = StratifiedKFold(self.n_folds, shuffle=True, random_state=self.seed).split(positions, labels)
+            else:
+                splitter = KFold(self.n_folds, shuffle=True, random_state=self.seed).split(positions)
+            for fold, (_, test) in enumerate(splitter):
+                fold_ids[test] = fold
+            self.fold_ids[part] = fold_ids
+        fold_ids = self.fold_ids[part]
+        return [(np.flatnonzero(fold_ids != fold), np.flatnonzero(fold_ids == fold)) for fold in range(self.n_folds)]
+
+
+def locked(method):
+    # the GUI calls into Model from the Tk thread and the job thread, so anything that syncs or swaps the estimator
+    # holds the model lock
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+@instrument.instrument_class("model")
 class Model:
     def __init__(self, *args):
         self.db = args[0]
-        self.model = GaussianNB()
-        self.data = self.db.fetch_data()
-        self.df = pd.DataFrame(self.data, columns=self.db.fetch_names())
-        self.X_train = self.df.iloc[:, :-1].values
-        self.y_train = self.df.iloc[:, -1].values
-        self.X_test = self.X_train
-        self.y_test = self.y_train
+        self.lock = threading.RLock()
+        self.engine = "gaussian_nb"
+        self.dtype = np.float64
+        self.model = make_estimator(self.engine)
+        self.kernel_cache = None
+        self._X, self._y, self.rowid = self.db.fetch_arrays()
+        self.size = len(self._y)
+        self.learned_rowid = 0
+        self.learned_size = 0
+        self.seed = 0
+        self.folds = 5
+        self.split = Split(self.size)
         self.best_model = None
+        self.var_smoothing_grid = VAR_SMOOTHING_GRID
+        self.n_jobs = -1
+        self.searches = {}
+        self.version = 0
+        self.evaluations = {}
+        self.registry = None
+        self.stale = False
+
+    @property
+    def X(self):
+        return self._X[:self.size]
+
+    @property
+    def X_train(self):
+        return self.split.take(self.X, self.y, "train")[0]
+
+    @property
+    def y_train(self):
+        return self.split.take(self.X, self.y, "train")[1]
+
+    @property
+    def X_test(self):
+        return self.split.take(self.X, self.y, "test")[0]
+
+    @property
+    def y_test(self):
+        return self.split.take(self.X, self.y, "test")[1]
+
+    @property
+    def y(self):
+        return self._y[:self.size]
+
+    def extend(self, features, labels):
+        end = self.size + len(labels)
+        label_dtype = np.result_type(self._y.dtype, labels.dtype)
+        if end > len(self._y) or label_dtype != self._y.dtype:
+            capacity = max(end, 2 * len(self._y))
+            X = np.empty((capacity, self._X.shape[1]), dtype=np.float64)
+            y = np.empty(capacity, dtype=label_dtype)
+            X[:self.size] = self.X
+            y[:self.size] = self.y
+            self._X, self._y = X, y
+        self._X[self.size:end] = features
+        self._y[self.size:end] = labels
+        self.size = end
+
+    @locked
+    def sync(self):
+        X, y, self.rowid = self.db.fetch_arrays(after=self.rowid)
+        self.extend(X, y)
+        return len(y)
+
+    def changed(self):
+        self.version += 1
+        self.evaluations = {}
+
+    def fitted(self):
+        return hasattr(self.model, "classes_")
+
+    def kernel(self):
+        if self.kernel_cache is None or self.kernel_cache[0] != (self.version, self.dtype):
+            self.kernel_cache = ((self.version, self.dtype), FastGaussianNB(self.model, self.dtype))
+        return self.kernel_cache[1]
+
+    @locked
+    def update(self):
+        self.sync()
+        if not self.fitted() or self.learned_size >= self.size:
+            return 0
+        X = self.X[self.learned_size:]
+        y = self.y[self.learned_size:]
+        if not hasattr(self.model, "partial_fit"):
+            # the engine only learns through a full refit, which waits for the next train
+            self.stale = True
+            return 0
+        if np.isin(y, self.model.classes_).all():
+            self.model.partial_fit(X, y)
+        else:
+            # a new category appeared, refit on the training rows and the rows loaded since, never the test rows
+            train = self.split.train if self.split.train is not None else np.arange(self.split.n)
+            rows = np.concatenate([train, np.arange(self.split.n, self.size)])
+            self.model.fit(self.X[rows], self.y[rows])
+        self.learned_rowid = self.rowid
+        self.learned_size = self.size
+        self.changed()
+        return len(y)
 
     def predict(self, data_to_pred):
-        df = pd.DataFrame(data_to_pred)
         try:
-            prediction = self.model.predict(df)
+            prediction = self.predict_batch(data_to_pred)
             return prediction[0]
         except NotFittedError as e:
             return "0"
 
-    def train(self, split, size):
-        X = self.X_train
-        y = self.y_train
+    def predict_batch(self, data, proba=False):
+        if not isinstance(data, (np.ndarray, list, tuple)):
+            results = [self.predict_batch(chunk, proba) for chunk in data]
+            if proba:
+                return (np.concatenate([labels for labels, _ in results]),
+                        np.concatenate([probabilities for _, probabilities in results]))
+            return np.concatenate(results)
+        instrument.count("model.rows_predicted", len(data))
+        if isinstance(self.model, GaussianNB):
+            kernel = self.kernel()
+            if proba:
+                probabilities = kernel.predict_proba(data)
+                return self.model.classes_[probabilities.argmax(axis=1)], probabilities
+            return kernel.predict(data)
+        X = np.asarray(data, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if proba:
+            probabilities = self.model.predict_proba(X)
+            return self.model.classes_[probabilities.argmax(axis=1)], probabilities
+        return self.model.predict(X)
+
+    def score_file(self, file, out_file, chunk_size=dbsql.CHUNK_SIZE):
+        total = 0
+        start = time.perf_counter()
+        with dbsql.open_data_file(file) as file_object, open(out_file, "w") as out:
+            reader = csv.reader(file_object)
+            while True:
+                lines = list(filter(None, itertools.islice(reader, chunk_size)))
+                if not lines:
+                    break
+                X = np.array(lines, dtype=np.float64)
+                if X.shape[1] == len(dbsql.COLUMNS):
+                    # UCI rows carry the known category in front
+                    X = X[:, 1:]
+                labels = self.predict_batch(X)
+                out.write("\n".join(map(str, labels.tolist())) + "\n")
+                total += len(labels)
+        report("Scored", total, start)
+        return total
+
+    def score_table(self, chunk_size=dbsql.CHUNK_SIZE):
+        total = 0
+        start = time.perf_counter()
+        for rowids, X, _ in self.db.iter_chunks(chunk_size):
+            self.db.write_predictions(rowids, self.predict_batch(X))
+            total += len(rowids)
+        report("Scored", total, start)
+        return total
+
+    @locked
+    def train_store(self, store, chunk_size=dbsql.CHUNK_SIZE):
+        self.engine = "gaussian_nb"
+        self.model = GaussianNB(var_smoothing=self.var_smoothing())
+        for X, y in store.iter_chunks(chunk_size):
+            self.model.partial_fit(X, y, classes=store.classes)
+        self.changed()
+        return self.model
+
+    def evaluate_store(self, store, folds=5, chunk_size=dbsql.CHUNK_SIZE):
+        bounds = np.linspace(0, len(store), folds + 1).astype(np.int64)
+        scores = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            estimator = GaussianNB(var_smoothing=self.var_smoothing())
+            for part_start, part_end in ((0, start), (end, len(store))):
+                for X, y in store.iter_chunks(chunk_size, part_start, part_end):
+                    estimator.partial_fit(X, y, classes=store.classes)
+            correct = 0
+            for X, y in store.iter_chunks(chunk_size, start, end):
+                correct += np.count_nonzero(estimator.predict(X) == y)
+            scores.append(float(correct / max(end - start, 1)))
+        return {"scores": scores, "avg": float(np.mean(scores))}
+
+    def predict_store(self, store, file=None, chunk_size=dbsql.CHUNK_SIZE):
+        file = file or os.path.join(store.directory, "predictions.npy")
+        predictions = open_memmap(file, mode="w+", dtype=self.model.classes_.dtype, shape=(len(store),))
+        pos = 0
+        for X, _ in store.iter_chunks(chunk_size):
+            predictions[pos:pos + len(X)] = self.predict_batch(X)
+            pos += len(X)
+        predictions.flush()
+        return predictions
 
-        if split:
-            self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(X, y, test_size=size / 100)
+    def save(self, file):
+        if not self.fitted():
+            raise NotFittedError("Train the model before saving it")
+        if not isinstance(self.model, GaussianNB):
+            raise ValueError(f"Only gaussian_nb models can be saved, this one uses {self.engine}")
+        save_artifact(file, self.model, self.best_model, self.learned_rowid)
+
+    @locked
+    def load(self, file):
+        self.model, self.best_model, self.learned_rowid = load_artifact(file)
+        self.engine = "gaussian_nb"
+        self.changed()
+        self.learned_size = min(self.db.count(self.learned_rowid), self.size)
+        self.stale = False
+
+    @locked
+    def train(self, split, size, engine=None, check=None):
+        # check() raises to cancel, the previous model stays in place unless training runs to the end
+        state = (self.engine, self.model, self.split, self.best_model, self.learned_rowid, self.learned_size)
+        try:
+            self.engine = engine or self.engine
+            self.model = make_estimator(self.engine)
+            self.split = Split(self.size, size / 100 if split else 0.0, self.seed, self.y, self.folds)
+            if self.registry is not None:
+                data = fingerprint(self.X_train, self.y_train)
+                grid = repr(self.param_grid())
+                key = self.registry.key(data, self.engine, self.model.get_params(), grid, self.seed, self.folds)
+                if self.use(key):
+                    return
             self.model.fit(self.X_train, self.y_train)
-        else:
-            self.model.fit(X, y)
-        self.evaluate_best("train")
+            if check is not None:
+                check()
+            self.learned_rowid = self.rowid
+            self.learned_size = self.size
+            self.changed()
+            res = self.evaluate_best("train", check)
+        except BaseException:
+            self.engine, self.model, self.split, self.best_model, self.learned_rowid, self.learned_size = state
+            self.changed()
+            raise
+        self.stale = False
+        if self.registry is not None:
+            results = res["param_grid"][["params", "mean_test_score", "std_test_score", "rank_test_score"]]
+            metrics = {"avg": res["avg"], "best_param": res["best_param"], "best_score": res["best_score"],
+                       "param_grid": results.to_dict("records")}
+            self.registry.put(key, self.model, self.best_model,
+                              {"engine": self.engine, "data": data, "grid": grid, "seed": self.seed,
+                               "folds": self.folds, "rows": self.split.n, "test_size": self.split.test_size,
+                               "learned_rowid": self.learned_rowid, "metrics": metrics})
+
+    @locked
+    def use(self, key):
+        entry = self.registry.get(key)
+        if entry is None:
+            return False
+        estimator, best, meta = entry
+        if meta["rows"] > self.size:
+            return False
+        self.model, self.best_model = estimator, best
+        self.engine = meta["engine"]
+        if (self.split.n, self.split.test_size, self.split.seed) != (meta["rows"], meta["test_size"], meta["seed"]):
+            self.split = Split(meta["rows"], meta["test_size"], meta["seed"], self.y, meta["folds"])
+        self.learned_rowid = meta["learned_rowid"]
+        self.learned_size = min(self.db.count(self.learned_rowid), self.size)
+        self.stale = False
+        self.changed()
+        # the stored search result answers evaluate_best without running the grid search again
+        metrics = dict(meta["metrics"], param_grid=pd.DataFrame(meta["metrics"]["param_grid"]))
+        self.searches[(meta["data"], self.engine, meta["grid"], meta["seed"], meta["folds"])] = (metrics, best)
+        return True
+
+    def var_smoothing(self):
+        return self.model.var_smoothing if isinstance(self.model, GaussianNB) else GaussianNB().var_smoothing
+
+    def param_grid(self):
+        grid = {"var_smoothing": self.var_smoothing_grid} if self.engine == "gaussian_nb" else ENGINES[self.engine][1]
+        current = self.model.get_params()
+        # the current setting is always searched, so its cross-validation score comes from the same search
+        return {name: list(values) + ([current[name]] if current[name] not in values else [])
+                for name, values in grid.items()}
 
     def check(self, tset):
         if tset == "train":
@@ -45,50 +542,125 @@ class Model:
             y = self.y_test
         return X, y
 
-    def evaluate_best(self, tset):
+    @locked
+    def evaluate_best(self, tset, check=None):
         X, y = self.check(tset)
+        param_grid = self.param_grid()
+        folds = self.split.folds(tset)
+        key = (fingerprint(X, y), self.engine, repr(param_grid), self.split.seed, self.split.n_folds)
+        if key in self.searches:
+            res, best_model = self.searches[key]
+            if best_model is not self.best_model:
+                self.best_model = best_model
+                self.changed()
+            return res
 
-        kfold = KFold()
-        scores = cross_val_score(self.model, X, y, cv=kfold, scoring="accuracy")
-        avg = scores.mean()
-        param_grid = {'priors': [None],
-                      'var_smoothing': [1e-9, 1e-6, 1e-12]}
-        grid_search = GridSearchCV(self.model, param_grid, cv=kfold)
+        grid_search = GridSearchCV(make_estimator(self.engine), param_grid, cv=folds, n_jobs=self.n_jobs)
         grid_search.fit(X, y)
+        if check is not None:
+            check()
         results = pd.DataFrame(grid_search.cv_results_)
+        current = {name: self.model.get_params()[name] for name in param_grid}
+        avg = results["mean_test_score"][grid_search.cv_results_["params"].index(current)]
         best_param = grid_search.best_params_
         best_score = grid_search.best_score_
         self.best_model = grid_search.best_estimator_
+        self.changed()
 
         res = {"avg": avg, "param_grid": results, "best_param": best_param, "best_score": best_score}
+        if len(self.searches) >= SEARCH_CACHE_SIZE:
+            self.searches.pop(next(iter(self.searches)))
+        self.searches[key] = (res, self.best_model)
         return res
 
+    @locked
+    def evaluate_sharded(self, workers=None):
+        # cross-validates on the whole Wines table in worker processes instead of the in-memory split
+        import sharded
+        if self.engine != "gaussian_nb":
+            raise ValueError(f"Sharded evaluation supports gaussian_nb, this model uses {self.engine}")
+        if workers is None and self.n_jobs > 0:
+            workers = self.n_jobs
+        grid = sorted(set(self.var_smoothing_grid) | {self.var_smoothing()})
+        res = sharded.cross_validate(self.db, grid, self.folds, workers, self.seed)
+        scores = res["scores"]
+        results = pd.DataFrame({"params": [{"var_smoothing": value} for value in grid],
+                                "param_var_smoothing": grid,
+                                **{f"split{fold}_test_score": scores[:, fold] for fold in range(self.folds)},
+                                "mean_test_score": scores.mean(axis=1),
+                                "std_test_score": scores.std(axis=1)})
+        best = res["best"]
+        n = res["n"]
+        self.best_model = estimator_from_stats(res["classes"], n, res["mean"], res["m2"] / n[:, None], grid[best])
+        self.changed()
+        return {"avg": results["mean_test_score"][grid.index(self.var_smoothing())], "param_grid": results,
+                "best_param": {"var_smoothing": grid[best]}, "best_score": results["mean_test_score"][best],
+                "matrix": res["confusion"][best].sum(axis=0)}
+
+    @locked
+    def evaluate(self, tset):
+        key = (self.version, tset)
+        if key not in self.evaluations:
+            X, y = self.check(tset)
+            predicted = self.best_model.predict(X)
+            self.evaluations[key] = {"accuracy": accuracy_score(y, predicted),
+                                     "matrix": confusion_matrix(y, predicted),
+                                     "report": classification_report(y, predicted)}
+        return self.evaluations[key]
+
     def evaluate_accuracy(self, tset):
-        X, y = self.check(tset)
-        best_predict = self.best_model.predict(X)
-        acc = accuracy_score(y, best_predict)
-        return acc
+        return self.evaluate(tset)["accuracy"]
 
     def evaluate_matrix(self, tset):
-        X, y = self.check(tset)
-        cm = confusion_matrix(y, self.best_model.predict(X))
-        return cm
+        return self.evaluate(tset)["matrix"]
 
     def evaluate_report(self, tset):
-        X, y = self.check(tset)
-        report = classification_report(y, self.best_model.predict(X))
-        return report
+        return self.evaluate(tset)["report"]
 
+    @locked
     def rebuild(self, database):
-        self.refresh(database)
-        self.model = GaussianNB()
-        self.X_train = self.df.iloc[:, :-1].values
-        self.y_train = self.df.iloc[:, -1].values
-        self.X_test = self.X_train
-        self.y_test = self.y_train
-        self.best_model = None
+        self.db = database
+        self.fit_stats()
+        self.split = Split(self.size)
+        self.best_model = self.model
+        self.changed()
 
+    @locked
+    def fit_stats(self, stable=True):
+        # syncing in the same read transaction keeps the loaded rows and the statistics on the same rowid
+        with self.db.transaction():
+            self.sync()
+            stats = self.db.fetch_stats()
+        # a feature left NULL in some rows has a smaller count than the category itself
+        counts = np.maximum(stats["n"], 1)
+        n = stats["n"].max(axis=1)
+        if not len(n):
+            self.model = GaussianNB(var_smoothing=self.var_smoothing())
+            self.engine = "gaussian_nb"
+            self.changed()
+            return self.model
+        if stable:
+            means = stats["mean"]
+            variances = stats["m2"] / counts
+        else:
+            means = stats["total"] / counts
+            variances = np.maximum(stats["total_sq"] / counts - means ** 2, 0.0)
+        estimator = estimator_from_stats(stats["categories"], n, means, variances, self.var_smoothing())
+        self.model = estimator
+        self.engine = "gaussian_nb"
+        self.learned_rowid = stats["rowid"]
+        self.learned_size = self.size
+        self.stale = False
+        self.changed()
+        return estimator
+
+    @locked
     def refresh(self, database):
-        self.db = database
-        self.data = self.db.fetch_data()
-        self.df = pd.DataFrame(self.data, columns=self.db.fetch_names())
+        if database is not self.db:
+            self.db = database
+            self.rowid = 0
+            self.size = 0
+        self.sync()
+
+    def pending(self):
+        return self.db.version() > self.rowid
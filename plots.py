@@ -0,0 +1,145 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+
+import numpy as np
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+
+import dbsql
+import instrument
+import tableview
+
+KINDS = ("Categories", "Histogram", "Scatter", "Density")
+SAMPLE_SIZE = 5000
+BINS = 30
+DENSITY_POINTS = 200
+WATCH_INTERVAL = 2000
+
+
+def density(values, grid):
+    # Gaussian kernel density with Scott's bandwidth, on a sample small enough to evaluate directly
+    if len(values) < 2 or values.std() == 0:
+        return np.zeros_like(grid)
+    bandwidth = values.std() * len(values) ** (-1 / 5)
+    z = (grid[:, None] - values[None, :]) / bandwidth
+    return np.exp(-0.5 * z * z).sum(axis=1) / (len(values) * bandwidth * np.sqrt(2 * np.pi))
+
+
+def collect(db, reservoir, kind, x, y):
+    if kind == "Categories":
+        return db.category_counts()
+    if kind == "Histogram":
+        return db.binned_histogram(x, BINS, by_category=True)
+
+    X, labels = reservoir.update()
+    columns = X[:, [dbsql.FEATURES.index(x), dbsql.FEATURES.index(y)]]
+    groups = {int(category): columns[labels == category] for category in np.unique(labels)}
+    if kind == "Scatter":
+        return groups, len(labels), reservoir.seen
+
+    values = columns[:, 0][~np.isnan(columns[:, 0])]
+    if not len(values):
+        return {}, len(labels), reservoir.seen
+    grid = np.linspace(values.min(), values.max(), DENSITY_POINTS)
+    curves = {category: (grid, density(points[:, 0][~np.isnan(points[:, 0])], grid))
+              for category, points in groups.items()}
+    return curves, len(labels), reservoir.seen
+
+
+def render(figure, kind, x, y, data):
+    figure.clear()
+    ax = figure.add_subplot()
+    if kind == "Categories":
+        ax.bar([str(category) for category in data], list(data.values()), width=0.4)
+        ax.set_xlabel("Category")
+        ax.set_ylabel("Count")
+        ax.set_title("Number of instances per category")
+        return
+
+    if kind == "Histogram":
+        edges, counts = data
+        bottom = np.zeros(len(edges) - 1, dtype=np.int64)
+        for category, bin_counts in sorted(counts.items()):
+            ax.bar(edges[:-1], bin_counts, width=np.diff(edges), align="edge", bottom=bottom,
+                   label=f"Category {category}", alpha=0.8)
+            bottom = bottom + bin_counts
+        ax.set_xlabel(tableview.HEADINGS[x])
+        ax.set_ylabel("Count")
+        ax.set_title(f"{tableview.HEADINGS[x]}, {int(bottom.sum())} rows")
+    elif kind == "Scatter":
+        groups, sampled, seen = data
+        for category, points in sorted(groups.items()):
+            ax.scatter(points[:, 0], points[:, 1], s=6, alpha=0.6, label=f"Category {category}")
+        ax.set_xlabel(tableview.HEADINGS[x])
+        ax.set_ylabel(tableview.HEADINGS[y])
+        ax.set_title(f"{sampled} sampled of {seen} rows")
+    else:
+        curves, sampled, seen = data
+        for category, (grid, values) in sorted(curves.items()):
+            ax.plot(grid, values, label=f"Category {category}")
+            ax.fill_between(grid, values, alpha=0.2)
+        ax.set_xlabel(tableview.HEADINGS[x])
+        ax.set_ylabel("Density")
+        ax.set_title(f"{sampled} sampled of {seen} rows")
+    ax.legend()
+
+
+class PlotView(tk.Frame):
+
+    def __init__(self, master, db, jobs, sample_size=SAMPLE_SIZE):
+        super().__init__(master)
+        self.db = db
+        self.jobs = jobs
+        self.reservoir = dbsql.Reservoir(db, sample_size)
+        self.version = None
+
+        toolbar = tk.Frame(self)
+        toolbar.pack(side="top", fill="x")
+        self.kind_box = self.combobox(toolbar, "Plot:", KINDS, KINDS[0])
+        self.x_box = self.combobox(toolbar, "X:", dbsql.FEATURES, dbsql.FEATURES[0])
+        self.y_box = self.combobox(toolbar, "Y:", dbsql.FEATURES, dbsql.FEATURES[1])
+        self.status_label = tk.Label(toolbar, text="")
+        self.status_label.pack(side="right", padx=5)
+
+        # one figure and one canvas for the lifetime of the view, redraws only replace the axes
+        self.figure = Figure(figsize=(7, 5), dpi=100)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        self.redraw()
+        self.after(WATCH_INTERVAL, self.watch)
+
+    def combobox(self, toolbar, text, values, value):
+        label = tk.Label(toolbar, text=text)
+        label.pack(side="left", padx=5)
+        box = ttk.Combobox(toolbar, values=list(values), state="readonly", width=18)
+        box.set(value)
+        box.bind("<<ComboboxSelected>>", self.redraw)
+        box.pack(side="left")
+        return box
+
+    def selection(self):
+        return self.kind_box.get(), self.x_box.get(), self.y_box.get()
+
+    def redraw(self, event=None):
+        kind, x, y = self.selection()
+        self.status_label.configure(text="Loading...")
+        self.version = self.db.version()
+        self.jobs.submit(("plot", kind, x, y), lambda job: (kind, x, y, collect(self.db, self.reservoir, kind, x, y)),
+                         on_done=self.show)
+
+    @instrument.timed("gui.plot_render")
+    def show(self, result):
+        kind, x, y, data = result
+        if not self.winfo_exists() or (kind, x, y) != self.selection():
+            return
+        render(self.figure, kind, x, y, data)
+        self.canvas.draw_idle()
+        self.status_label.configure(text="")
+
+    def watch(self):
+        if not self.winfo_exists():
+            return
+        # the aggregates and the sample follow the change feed, so a redraw only pays for the new rows
+        if self.db.version() != self.version:
+            self.redraw()
+        self.after(WATCH_INTERVAL, self.watch)
@@ -0,0 +1,113 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sklearn.naive_bayes import GaussianNB
+
+import instrument
+import model
+
+REGISTRY_DIR = "models"
+INDEX_FILE = "index.json"
+CACHE_SIZE = 8
+
+
+def plain(value):
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+class Registry:
+
+    def __init__(self, directory=REGISTRY_DIR, cache_size=CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+        except ValueError as e:
+            print(f"Error: {e}")
+            self.index = {}
+
+    @staticmethod
+    def key(data, engine, params, grid, seed, folds):
+        # everything that decides what train() produces: the training rows, the estimator and the search settings
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((data, engine, sorted(params.items()), grid, seed, folds)).encode())
+        return digest.hexdigest()
+
+    def __contains__(self, key):
+        return key in self.cache or self.index.get(key, {}).get("file") is not None
+
+    def get(self, key):
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                instrument.count("registry.hits")
+                return self.copy(self.cache[key])
+            meta = self.index.get(key)
+            if meta is None or meta["file"] is None:
+                self.misses += 1
+                instrument.count("registry.misses")
+                return None
+            estimator, best, _ = model.load_artifact(os.path.join(self.directory, meta["file"]))
+            instrument.count("registry.loads")
+            return self.copy(self.remember(key, (estimator, best, meta)))
+
+    def put(self, key, estimator, best, meta):
+        meta = dict(meta, key=key, created=time.time(), file=None)
+        # only GaussianNB has a pickle-free artifact format, other engines stay in the in-process cache
+        if isinstance(estimator, GaussianNB) and (best is None or isinstance(best, GaussianNB)):
+            meta["file"] = f"{key}.npz"
+            model.save_artifact(os.path.join(self.directory, meta["file"]), estimator, best, meta["learned_rowid"])
+        with self._lock:
+            self.index[key] = meta
+            self.write_index()
+            # Model keeps partial_fitting the estimator it trained, so the cache holds its own copy
+            self.remember(key, (copy.deepcopy(estimator), copy.deepcopy(best), meta))
+        return meta
+
+    def remember(self, key, entry):
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def copy(entry):
+        estimator, best, meta = entry
+        return copy.deepcopy(estimator), copy.deepcopy(best), dict(meta)
+
+    def remove(self, key):
+        with self._lock:
+            self.cache.pop(key, None)
+            meta = self.index.pop(key, None)
+            self.write_index()
+        if meta is not None and meta["file"] is not None:
+            try:
+                os.remove(os.path.join(self.directory, meta["file"]))
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        with self._lock:
+            return sorted((meta for key, meta in self.index.items() if key in self),
+                          key=lambda meta: meta["created"], reverse=True)
+
+    def write_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2, default=plain)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import model
+
+MAX_BATCH = 4096
+MAX_DELAY = 0.002
+MAX_BODY = 16 * 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Batcher:
+
+    def __init__(self, estimator, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.estimator = estimator
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.rows = 0
+
+    async def predict(self, X):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((X, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            rows = len(pending[0][0])
+            deadline = loop.time() + self.max_delay
+            while rows < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                rows += len(item[0])
+
+            X = np.concatenate([item[0] for item in pending])
+            try:
+                labels = await loop.run_in_executor(None, self.estimator.predict, X)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.rows += len(X)
+            pos = 0
+            for item, future in pending:
+                if not future.done():
+                    future.set_result(labels[pos:pos + len(item)])
+                pos += len(item)
+
+
+class PredictionServer:
+
+    def __init__(self, file, host="127.0.0.1", port=8080, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.file = file
+        self.host = host
+        self.port = port
+        self.estimator = model.FastGaussianNB(model.load_artifact(file)[0])
+        self.batcher = Batcher(self.estimator, max_batch, max_delay)
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, {"error": "Request body too large"}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                close = headers.get("connection", "").lower() == "close"
+
+                start = time.perf_counter()
+                try:
+                    status, payload = 200, await self.route(method, path.split("?", 1)[0], body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                    self.errors += 1
+                self.requests += 1
+                self.latency += time.perf_counter() - start
+                await self.respond(writer, status, payload, close)
+                if close:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if path == "/health":
+            return {"status": "ok", "model": self.file}
+        if path == "/metrics":
+            return self.metrics()
+        if path != "/predict":
+            raise HTTPError(404, f"Unknown path {path}")
+        if method != "POST":
+            raise HTTPError(405, "Use POST for /predict")
+
+        try:
+            request = json.loads(body)
+            single = "instance" in request
+            X = np.array([request["instance"]] if single else request["instances"], dtype=np.float64)
+        except (ValueError, TypeError, KeyError):
+            raise HTTPError(400, "Expected JSON with 'instance' or 'instances'")
+        if X.ndim != 2 or X.shape[1] != self.estimator.n_features_in_:
+            raise HTTPError(400, f"Expected rows of {self.estimator.n_features_in_} features")
+        if not np.isfinite(X).all():
+            # null or non-finite features would still get a class, the first one argmax sees
+            raise HTTPError(400, "Feature values must be finite numbers")
+
+        labels = (await self.batcher.predict(X)).tolist()
+        return {"prediction": labels[0]} if single else {"predictions": labels}
+
+    def metrics(self):
+        return {"uptime": time.time() - self.started,
+                "requests": self.requests,
+                "errors": self.errors,
+                "mean_latency": self.latency / self.requests if self.requests else 0.0,
+                "batches": self.batcher.batches,
+                "rows": self.batcher.rows,
+                "mean_batch_rows": self.batcher.rows / self.batcher.batches if self.batcher.batches else 0.0}
+
+    async def respond(self, writer, status, payload, close=False):
+        body = json.dumps(payload).encode()
+        head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def serve(self):
+        worker = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Serving {self.file} on http://{self.host}:{self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+    def run(self):
+        asyncio.run(self.serve())
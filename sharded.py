@@ -0,0 +1,142 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import dbsql
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def fold_ids(rowids, folds, seed=0):
+    # the fold of a row depends only on its rowid, so every worker agrees without sharing an assignment array
+    h = (rowids.astype(np.uint64) + np.uint64(seed)) * GOLDEN
+    h ^= h >> np.uint64(29)
+    h *= GOLDEN
+    h ^= h >> np.uint64(32)
+    return (h % np.uint64(folds)).astype(np.int64)
+
+
+def shards(db, count):
+    first, last = db.connection().execute("SELECT Min(rowid), Max(rowid) FROM Wines").fetchone()
+    if last is None:
+        return []
+    bounds = np.linspace(first - 1, last, count + 1).astype(np.int64)
+    return [(int(after), int(upto)) for after, upto in zip(bounds[:-1], bounds[1:]) if upto > after]
+
+
+def merge(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    # Chan et al. pairwise update, the same merge WineStats uses
+    n = n_a + n_b
+    safe = np.where(n > 0, n, 1)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / safe
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / safe
+    return n, mean, m2
+
+
+def group_stats(X, groups, size):
+    n = np.bincount(groups, minlength=size).astype(np.float64)[:, None]
+    safe = np.where(n > 0, n, 1)
+    mean = np.stack([np.bincount(groups, X[:, i], size) for i in range(X.shape[1])], axis=1) / safe
+    diff = X - mean[groups]
+    m2 = np.stack([np.bincount(groups, diff[:, i] * diff[:, i], size) for i in range(X.shape[1])], axis=1)
+    return n, mean, m2
+
+
+def collect_stats(db, after, upto, classes, folds, seed, chunk_size):
+    size = folds * len(classes)
+    n = np.zeros((size, len(dbsql.FEATURES)))
+    mean = np.zeros_like(n)
+    m2 = np.zeros_like(n)
+    for rowids, X, y in db.iter_chunks(chunk_size, after, upto):
+        groups = fold_ids(rowids, folds, seed) * len(classes) + np.searchsorted(classes, y)
+        n, mean, m2 = merge(n, mean, m2, *group_stats(X, groups, size))
+    db.close()
+    shape = (folds, len(classes), len(dbsql.FEATURES))
+    return n.reshape(shape), mean.reshape(shape), m2.reshape(shape)
+
+
+def fold_params(n, mean, m2, grid):
+    # GaussianNB fitted on every fold but one, from the per-fold sufficient statistics alone
+    folds = n.shape[0]
+    thetas, inv_vars, consts = [], [], []
+    for fold in range(folds):
+        train = [f for f in range(folds) if f != fold]
+        n_t, mean_t, m2_t = n[train[0]], mean[train[0]], m2[train[0]]
+        for f in train[1:]:
+            n_t, mean_t, m2_t = merge(n_t, mean_t, m2_t, n[f], mean[f], m2[f])
+        counts = n_t[:, 0]
+        total = counts.sum()
+        present = counts > 0
+        variances = m2_t / np.where(counts > 0, counts, 1)[:, None]
+        pooled_mean = (counts[:, None] * mean_t).sum(axis=0) / total
+        pooled_var = (counts[:, None] * (variances + (mean_t - pooled_mean) ** 2)).sum(axis=0) / total
+        with np.errstate(divide="ignore"):
+            log_prior = np.where(present, np.log(counts / total), -np.inf)
+        fold_inv, fold_const = [], []
+        for var_smoothing in grid:
+            var = variances + var_smoothing * pooled_var.max()
+            var[~present] = 1.0
+            fold_inv.append(0.5 / var)
+            fold_const.append(log_prior - 0.5 * np.log(2.0 * np.pi * var).sum(axis=1))
+        thetas.append(mean_t)
+        inv_vars.append(fold_inv)
+        consts.append(fold_const)
+    return np.array(thetas), np.array(inv_vars), np.array(consts)
+
+
+def collect_confusion(db, after, upto, classes, folds, seed, params, chunk_size):
+    thetas, inv_vars, consts = params
+    grid_size = inv_vars.shape[1]
+    k = len(classes)
+    confusion = np.zeros((grid_size, folds, k * k), dtype=np.int64)
+    for rowids, X, y in db.iter_chunks(chunk_size, after, upto):
+        row_folds = fold_ids(rowids, folds, seed)
+        truth = np.searchsorted(classes, y)
+        for fold in range(folds):
+            mask = row_folds == fold
+            if not mask.any():
+                continue
+            diff = X[mask, None, :] - thetas[fold]
+            diff *= diff
+            for g in range(grid_size):
+                jll = consts[fold, g] - np.einsum("rcf,cf->rc", diff, inv_vars[fold, g])
+                confusion[g, fold] += np.bincount(truth[mask] * k + jll.argmax(axis=1), minlength=k * k)
+    db.close()
+    return confusion.reshape(grid_size, folds, k, k)
+
+
+def cross_validate(db, grid=(1e-9,), folds=5, workers=None, seed=0, chunk_size=dbsql.CHUNK_SIZE):
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    classes = np.array(db.categories(), dtype=np.int64)
+    ranges = shards(db, workers)
+    grid = tuple(grid)
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(ranges), 1))) as pool:
+        # first pass: per fold and class counts, means and squared deviations, a few KB per shard
+        n = np.zeros((folds, len(classes), len(dbsql.FEATURES)))
+        mean = np.zeros_like(n)
+        m2 = np.zeros_like(n)
+        for part in pool.map(collect_stats, *zip(*[(db, after, upto, classes, folds, seed, chunk_size)
+                                                    for after, upto in ranges])):
+            n, mean, m2 = merge(n, mean, m2, *part)
+
+        # second pass: every shard scores its own rows with the model that did not see their fold
+        params = fold_params(n, mean, m2, grid)
+        confusion = np.zeros((len(grid), folds, len(classes), len(classes)), dtype=np.int64)
+        for part in pool.map(collect_confusion, *zip(*[(db, after, upto, classes, folds, seed, params, chunk_size)
+                                                        for after, upto in ranges])):
+            confusion += part
+
+    correct = np.trace(confusion, axis1=2, axis2=3)
+    scores = correct / np.maximum(confusion.sum(axis=(2, 3)), 1)
+    best = int(scores.mean(axis=1).argmax())
+    total_n, total_mean, total_m2 = n[0], mean[0], m2[0]
+    for fold in range(1, folds):
+        total_n, total_mean, total_m2 = merge(total_n, total_mean, total_m2, n[fold], mean[fold], m2[fold])
+    rows = int(total_n[:, 0].sum())
+    print(f"Cross-validated {rows} rows on {len(ranges)} shards in {time.perf_counter() - start:.2f}s")
+    return {"grid": grid, "scores": scores, "confusion": confusion, "best": best, "classes": classes,
+            "n": total_n[:, 0], "mean": total_mean, "m2": total_m2}
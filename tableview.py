@@ -0,0 +1,119 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+
+import dbsql
+import instrument
+
+HEADINGS = {"alcohol": "Alcohol", "malic_acid": "Malic acid", "ash": "Ash", "alcalinity_of_ash": "Alcalinity of ash",
+            "magnesium": "Magnesium", "total_phenols": "Total phenols", "flavanoids": "Flavanoids",
+            "nonflavanoid_phenols": "Nonflavanoid phenols", "proanthocyanins": "Proanthocyanins",
+            "color_intensity": "Color intensity", "hue": "Hue", "diluted": "OD280/OD315 of diluted wines",
+            "proline": "Proline", "category": "Category"}
+VISIBLE_ROWS = 25
+WATCH_INTERVAL = 1000
+ALL = "All"
+
+
+class TableView(tk.Frame):
+
+    def __init__(self, master, db, jobs, visible_rows=VISIBLE_ROWS):
+        super().__init__(master)
+        self.db = db
+        self.jobs = jobs
+        self.visible_rows = visible_rows
+        self.offset = 0
+        self.query = ("rowid", False, None)
+        self.pager = dbsql.Pager(db)
+
+        toolbar = tk.Frame(self)
+        toolbar.pack(side="top", fill="x")
+        category_label = tk.Label(toolbar, text="Category:")
+        category_label.pack(side="left", padx=5)
+        self.category_box = ttk.Combobox(toolbar, values=[ALL] + db.categories(), state="readonly", width=10)
+        self.category_box.set(ALL)
+        self.category_box.bind("<<ComboboxSelected>>", self.filter)
+        self.category_box.pack(side="left")
+        self.status_label = tk.Label(toolbar, text="")
+        self.status_label.pack(side="right", padx=5)
+
+        self.scroll = tk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.scroll.pack(side="right", fill="y")
+
+        self.treeview = ttk.Treeview(self, columns=dbsql.COLUMNS, show="headings", height=visible_rows)
+        for column in dbsql.COLUMNS:
+            self.treeview.heading(column, text=HEADINGS[column], command=lambda c=column: self.sort(c))
+            self.treeview.column(column, width=90)
+        self.treeview.bind("<MouseWheel>", lambda event: self.scroll_to(self.offset - 3 * (event.delta // 120)))
+        self.treeview.bind("<Button-4>", lambda event: self.scroll_to(self.offset - 3))
+        self.treeview.bind("<Button-5>", lambda event: self.scroll_to(self.offset + 3))
+        self.treeview.pack(fill="both", expand=True)
+        self.render()
+        self.after(WATCH_INTERVAL, self.watch)
+
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * self.pager.total))
+        elif args[0] == "scroll":
+            step = self.visible_rows if args[2] == "pages" else 1
+            self.scroll_to(self.offset + int(args[1]) * step)
+
+    def scroll_to(self, offset):
+        offset = max(0, min(offset, self.pager.total - self.visible_rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    @instrument.timed("gui.table_render")
+    def render(self):
+        rows = self.pager.rows(self.offset, self.visible_rows)
+        self.treeview.delete(*self.treeview.get_children())
+        for row in rows:
+            self.treeview.insert("", "end", values=row)
+
+        total = self.pager.total
+        if total:
+            self.scroll.set(self.offset / total, (self.offset + len(rows)) / total)
+        else:
+            self.scroll.set(0, 1)
+        self.status_label.configure(text=f"{total} rows")
+
+    def watch(self):
+        if not self.winfo_exists():
+            return
+        # rows inserted anywhere, by this window or another process, show up without a requery
+        if self.pager.update():
+            self.offset = max(0, min(self.offset, self.pager.total - self.visible_rows))
+            self.render()
+        self.after(WATCH_INTERVAL, self.watch)
+
+    def sort(self, column):
+        order, descending, category = self.query
+        self.requery(column, not descending if column == order else False, category)
+
+    def filter(self, event=None):
+        category = self.category_box.get()
+        order, descending, _ = self.query
+        self.requery(order, descending, None if category == ALL else int(category))
+
+    def requery(self, order, descending, category):
+        self.query = (order, descending, category)
+        self.status_label.configure(text="Loading...")
+
+        def build(job):
+            # sorting and filtering run in SQL, so make sure an index backs them first
+            if category is not None and order != "rowid":
+                self.db.ensure_index("category", order)
+            elif category is not None:
+                self.db.ensure_index("category")
+            elif order != "rowid":
+                self.db.ensure_index(order)
+            return dbsql.Pager(self.db, order, descending, category)
+
+        self.jobs.submit(("table", order, descending, category), build, on_done=self.show)
+
+    def show(self, pager):
+        if not self.winfo_exists() or (pager.order, pager.descending, pager.category) != self.query:
+            return
+        self.pager = pager
+        self.offset = 0
+        self.render()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+import dbsql
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WINE_DATA = os.path.join(HERE, "wine.data")
+# the unversioned database the repository has always shipped, TEXT categories and an implicit rowid
+BASELINE_DB = os.path.join(HERE, "wine_database.db")
+
+
+def test_migrate_baseline_database(tmp_path):
+    path = str(tmp_path / "wine_database.db")
+    shutil.copy(BASELINE_DB, path)
+    old = sqlite3.connect(path)
+    old_rows = old.execute("SELECT rowid, * FROM Wines ORDER BY rowid").fetchall()
+    old.close()
+
+    db = dbsql.DbSQL(path, WINE_DATA)
+    conn = db.connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == dbsql.SCHEMA_VERSION
+    assert db.count() == len(old_rows) == 178
+    rows = conn.execute(f"SELECT id, {', '.join(dbsql.COLUMNS)} FROM Wines ORDER BY id").fetchall()
+    assert [row[0] for row in rows] == [row[0] for row in old_rows]
+    assert [row[1:-1] for row in rows] == [row[1:-1] for row in old_rows]
+    assert [row[-1] for row in rows] == [int(row[-1]) for row in old_rows]
+    assert {row[0] for row in conn.execute("SELECT typeof(category) FROM Wines")} == {"integer"}
+
+    X, y, _ = db.fetch_arrays()
+    stats = db.fetch_stats()
+    assert list(stats["categories"]) == [1, 2, 3]
+    assert np.array_equal(stats["n"][:, 0], np.bincount(y)[1:])
+    assert np.allclose(stats["mean"], [X[y == category].mean(axis=0) for category in (1, 2, 3)])
+    for feature, rows_binned in conn.execute("SELECT feature, Sum(n) FROM WineBins GROUP BY feature"):
+        assert rows_binned == 178, feature
+    assert {row[0] for row in conn.execute("SELECT rows FROM WineBinSteps")} == {178}
+    db.close()
+
+
+def test_incremental_aggregates_match_recompute(tmp_path):
+    db = dbsql.DbSQL(str(tmp_path / "wine.db"), WINE_DATA)
+    # cache both aggregates first, so the insert below goes through the incremental update
+    db.category_counts()
+    db.feature_stats(by_category=True)
+    db.insert_many([list(row) for row in db.fetch_data()[:50]])
+    counts = db.category_counts()
+    stats = db.feature_stats(by_category=True)
+    db.aggregates.clear()
+    assert counts == db.category_counts()
+    fresh = db.feature_stats(by_category=True)
+    assert stats.keys() == fresh.keys()
+    for category in stats:
+        for name in dbsql.FEATURES:
+            for field, value in fresh[category][name].items():
+                assert np.isclose(stats[category][name][field], value), (category, name, field)
+    db.close()
+
+
+def test_write_buffer_keeps_rows_when_insert_fails(tmp_path):
+    db = dbsql.DbSQL(str(tmp_path / "wine.db"), WINE_DATA)
+    rows = [list(row) for row in db.fetch_data()[:20]]
+    buffer = dbsql.WriteBuffer(db, max_rows=100)
+    buffer.extend(rows + [[None] * len(dbsql.FEATURES) + ["red"]])
+    with pytest.raises((sqlite3.Error, ValueError)):
+        buffer.flush()
+    assert db.count() == 178
+    assert len(buffer._rows) == 21
+    buffer._rows.pop()
+    assert buffer.flush() == 20
+    assert db.count() == 198
+    db.close()
+
+
+def test_parse_row_converts_form_values():
+    values = ["13.2"] * len(dbsql.FEATURES)
+    assert dbsql.parse_row(values + ["2.0"]) == [13.2] * len(dbsql.FEATURES) + [2]
+    assert dbsql.parse_row(values + [" 3 "])[-1] == 3
+    for bad in (values[:-1] + ["", "1"], values[:-1] + ["nan", "1"], values + ["1.5"], values + ["red"], values):
+        with pytest.raises(ValueError):
+            dbsql.parse_row(bad)
+
+
+def test_histogram_accepts_features_only(tmp_path):
+    db = dbsql.DbSQL(str(tmp_path / "wine.db"), WINE_DATA)
+    X, _, _ = db.fetch_arrays()
+    edges, counts = db.histogram("hue", 10)
+    assert np.array_equal(counts, np.histogram(X[:, dbsql.FEATURES.index("hue")], edges)[0])
+    for column in ("category", "rowid", "id", "created_at"):
+        with pytest.raises(ValueError):
+            db.histogram(column)
+    db.close()
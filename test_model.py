@@ -0,0 +1,21 @@
+import os
+
+import numpy as np
+
+import dbsql
+import model
+
+WINE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wine.data")
+
+
+def test_split_smaller_than_the_classes_falls_back_to_random(tmp_path):
+    db = dbsql.DbSQL(str(tmp_path / "wine.db"), WINE_DATA)
+    wines = model.Model(db)
+    for size in (1, 99):
+        split = model.Split(wines.size, size / 100, 0, wines.y)
+        assert len(split.train) + len(split.test) == wines.size
+        assert not np.intersect1d(split.train, split.test).size
+    wines.train(True, 1)
+    assert wines.fitted()
+    assert len(wines.X_test) == 2
+    db.close()
@@ -0,0 +1,26 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import dbsql
+import model
+import server
+
+WINE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wine.data")
+
+
+def test_predict_rejects_rows_that_are_not_finite(tmp_path):
+    db = dbsql.DbSQL(str(tmp_path / "wine.db"), WINE_DATA)
+    wines = model.Model(db)
+    wines.fit_stats()
+    wines.save(str(tmp_path / "model.npz"))
+    db.close()
+    app = server.PredictionServer(str(tmp_path / "model.npz"))
+    for instance in ([None] * len(dbsql.FEATURES), [float("inf")] + [1.0] * (len(dbsql.FEATURES) - 1)):
+        body = json.dumps({"instance": instance}).encode()
+        with pytest.raises(server.HTTPError) as error:
+            # nothing runs the batcher here, a row that got through would wait until the timeout
+            asyncio.run(asyncio.wait_for(app.route("POST", "/predict", body), 5))
+        assert error.value.status == 400
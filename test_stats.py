@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+from sklearn.naive_bayes import GaussianNB
+
+import dbsql
+import model
+
+WINE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wine.data")
+
+
+def load(tmp_path, extra=200, seed=0):
+    db = dbsql.DbSQL(str(tmp_path / "wine.db"), WINE_DATA)
+    X, y, _ = db.fetch_arrays()
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(y), extra)
+    noisy = X[picks] * rng.normal(1.0, 0.05, X[picks].shape)
+    db.insert_many([list(features) + [int(label)] for features, label in zip(noisy, y[picks])])
+    return db
+
+
+def test_fit_stats_matches_gaussian_nb(tmp_path):
+    db = load(tmp_path)
+    wines = model.Model(db)
+    estimator = wines.fit_stats()
+    reference = GaussianNB().fit(wines.X, wines.y)
+    assert len(wines.y) == 178 + 200
+    assert np.array_equal(estimator.classes_, reference.classes_)
+    assert np.allclose(estimator.class_prior_, reference.class_prior_)
+    assert np.allclose(estimator.theta_, reference.theta_)
+    assert np.allclose(estimator.var_, reference.var_)
+    db.close()
+
+
+
+def test_fit_stats_learns_rows_inserted_since_sync_once(tmp_path):
+    db = load(tmp_path, extra=0)
+    wines = model.Model(db)
+    db.insert_many([list(row) for row in db.fetch_data()[:50]])
+    estimator = wines.fit_stats()
+    assert estimator.class_count_.sum() == 228
+    assert wines.update() == 0
+    assert wines.model.class_count_.sum() == 228
+    db.close()
+
+
+def test_stats_skip_null_features(tmp_path):
+    db = load(tmp_path, extra=0)
+    row = list(db.fetch_data()[0])
+    row[0] = None
+    db.insert_many([row])
+    stats = db.fetch_stats()
+    db.rebuild_stats()
+    for name in ("n", "total", "total_sq", "mean", "m2"):
+        assert np.allclose(stats[name], db.fetch_stats()[name]), name
+    X, y, _ = db.fetch_arrays()
+    assert stats["n"][0, 0] == np.count_nonzero(y == 1) - 1
+    assert stats["n"][0, 1] == np.count_nonzero(y == 1)
+    assert np.isclose(stats["mean"][0, 0], np.nanmean(X[y == 1, 0]))
+    assert np.isclose(stats["m2"][0, 0], np.nanvar(X[y == 1, 0]) * stats["n"][0, 0])
+    db.close()